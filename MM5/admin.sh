@@ -4,6 +4,8 @@ set -euo pipefail
 HOST="${HOST:-127.0.0.1}"
 PORT="${PORT:-8888}"
 BASE_URL="http://${HOST}:${PORT}"
+# Which game, when rooms.py hosts several; unset means the front's default.
+GAME="${GAME:-}"
 
 die() { echo "admin.sh: $*" >&2; exit 1; }
 
@@ -15,11 +17,18 @@ Usage:
   ./admin.sh tick [step]
   ./admin.sh buy <username> <ticker> <qty>
   ./admin.sh sell <username> <ticker> <qty>
+  ./admin.sh batch <username> <file|->
   ./admin.sh time
   ./admin.sh user <username>
+  ./admin.sh market <title> <outcome> <outcome> [outcome...]
+  ./admin.sh settle <market_id> <winner>
+  ./admin.sh void <market_id>
+  ./admin.sh bet <username> <market_id> <outcome> <stake>
+  ./admin.sh metrics [pattern]
 
 Env overrides:
   HOST=127.0.0.1 PORT=8888 ./admin.sh ...
+  GAME=friday ./admin.sh ...           # pick the game behind rooms.py
 
 Examples:
   ./admin.sh set mikey 250
@@ -28,13 +37,25 @@ Examples:
   ./admin.sh tick 4
   ./admin.sh buy mikey AAPL 3
   ./admin.sh sell mikey AAPL 1
+  ./admin.sh batch mikey rebalance.txt   # lines like "sell GME 10" / "buy AAPL 2"; all fill or none do
   ./admin.sh user mikey
+  ./admin.sh market "Derby" Reds Blues Draw
+  ./admin.sh bet mikey 1 Reds 50
+  ./admin.sh settle 1 Reds
+  ./admin.sh metrics tick
 EOF
 }
 
 need() { command -v "$1" >/dev/null 2>&1 || die "missing dependency: $1"; }
 need curl
 
+CURL_GAME=()
+[[ -n "$GAME" ]] && CURL_GAME=(-H "X-MM-Game: ${GAME}")
+
+mm_curl() {
+  curl -sS ${CURL_GAME[@]+"${CURL_GAME[@]}"} "$@"
+}
+
 # If jq is available, pretty print JSON, otherwise just raw.
 pretty() {
   if command -v jq >/dev/null 2>&1; then jq; else cat; fi
@@ -42,7 +63,7 @@ pretty() {
 
 post_admin() {
   local json="$1"
-  curl -sS -X POST "${BASE_URL}/admin" \
+  mm_curl -X POST "${BASE_URL}/admin" \
     -H "Content-Type: application/json" \
     -d "${json}"
 }
@@ -50,14 +71,14 @@ post_admin() {
 post_json() {
   local endpoint="$1"
   local json="$2"
-  curl -sS -X POST "${BASE_URL}/${endpoint}" \
+  mm_curl -X POST "${BASE_URL}/${endpoint}" \
     -H "Content-Type: application/json" \
     -d "${json}"
 }
 
 get_user() {
   local username="$1"
-  curl -sS "${BASE_URL}/user?username=${username}"
+  mm_curl "${BASE_URL}/user?username=${username}"
 }
 
 cmd="${1:-}"
@@ -108,6 +129,54 @@ case "$cmd" in
     post_json "sell" "{\"username\":\"${user}\",\"symbol\":\"${ticker}\",\"qty\":${qty}}" | pretty
     ;;
 
+  batch)
+    [[ $# -eq 2 ]] || die "batch requires: <username> <file|->"
+    user="$1"; file="$2"
+    [[ "$file" == "-" || -r "$file" ]] || die "cannot read batch file: $file"
+    legs=""
+    while read -r side ticker qty _ || [[ -n "${side:-}" ]]; do
+      [[ -z "${side}" || "${side}" == \#* ]] && continue
+      [[ "${side}" == "buy" || "${side}" == "sell" ]] || die "bad line (want: buy|sell <ticker> <qty>): ${side} ${ticker:-} ${qty:-}"
+      [[ "${qty:-}" =~ ^[0-9]+$ ]] || die "bad qty for ${side} ${ticker:-}: ${qty:-}"
+      legs="${legs:+${legs},}{\"side\":\"${side}\",\"symbol\":\"${ticker}\",\"qty\":${qty}}"
+    done < <(if [[ "$file" == "-" ]]; then cat; else cat -- "$file"; fi)
+    [[ -n "$legs" ]] || die "no orders in batch file"
+    post_json "orders" "{\"username\":\"${user}\",\"legs\":[${legs}]}" | pretty
+    ;;
+
+  market)
+    [[ $# -ge 3 ]] || die "market requires: <title> <outcome> <outcome> [outcome...]"
+    title="$1"; shift
+    outcomes=""
+    for o in "$@"; do outcomes="${outcomes:+${outcomes},}\"${o}\""; done
+    post_admin "{\"cmd\":\"create_market\",\"title\":\"${title}\",\"kind\":\"parimutuel\",\"outcomes\":[${outcomes}]}" | pretty
+    ;;
+
+  settle)
+    [[ $# -eq 2 ]] || die "settle requires: <market_id> <winner>"
+    post_admin "{\"cmd\":\"settle_market\",\"market_id\":$1,\"winner\":\"$2\"}" | pretty
+    ;;
+
+  void)
+    [[ $# -eq 1 ]] || die "void requires: <market_id>"
+    post_admin "{\"cmd\":\"void_market\",\"market_id\":$1}" | pretty
+    ;;
+
+  bet)
+    [[ $# -eq 4 ]] || die "bet requires: <username> <market_id> <outcome> <stake>"
+    user="$1"; market="$2"; outcome="$3"; stake="$4"
+    post_json "bet" "{\"username\":\"${user}\",\"market_id\":${market},\"outcome\":\"${outcome}\",\"stake\":${stake}}" | pretty
+    ;;
+
+  metrics)
+    # Prometheus text; only answered for localhost. Optional grep pattern.
+    if [[ $# -ge 1 ]]; then
+      mm_curl "${BASE_URL}/metrics" | grep -- "$1" || true
+    else
+      mm_curl "${BASE_URL}/metrics"
+    fi
+    ;;
+
   *)
     die "unknown command: $cmd (run ./admin.sh --help)"
     ;;
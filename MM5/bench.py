@@ -0,0 +1,381 @@
+"""Load test for server.py.
+
+Starts the server on a throwaway data directory, registers N players and
+has each of them poll like an open phone would (dashboard.html via
+populate.js, or stock.html), with the /stream push disabled so every
+poller runs; dashboard players also keep a /wait_tick long-poll parked.
+Every --tick-every seconds the clock is advanced, and some players answer
+each tick with a burst of /buy, /sell and /transfer.
+
+Prints a JSON report (throughput, errors and p50/p95/p99 latency per
+endpoint) to stdout or --out, and a readable table to stderr:
+
+    python bench.py --players 50 --duration 30
+    python bench.py --players 200 --async --out async.json
+"""
+
+import argparse
+import http.client
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from urllib.parse import quote
+
+SYMBOLS = ("AAPL", "MSFT", "NVDA", "GOOGL", "JPM", "V", "GS", "XOM", "BHP", "RIO",
+           "BA", "CAT", "TSLA", "WMT", "MCD", "GME")
+
+# (seconds between requests, path template) for each page, as the pages poll
+# while /stream is down. {u} is the player's name, {s} a stock symbol.
+DASHBOARD_POLLS = [
+    (10.0, "/dashboard?username={u}&fields=user,stocks,holdings"),
+    (6.0, "/news?limit=3"),
+    (5.0, "/leaderboard?limit=5&username={u}"),
+]
+STOCK_PAGE_POLLS = [
+    (2.0, "/user?username={u}"),
+    (2.0, "/stocks"),
+    (2.0, "/holdings?username={u}"),
+    (2.0, "/stock?symbol={s}"),
+    (5.0, "/stock_history?symbol={s}&limit=120"),
+]
+# Share of players sitting on stock.html rather than the dashboard.
+STOCK_PAGE_SHARE = 0.3
+
+
+class Recorder:
+    """Latency samples per endpoint, shared by every player thread."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {}
+        self.errors = {}
+        self.statuses = {}
+
+    def add(self, endpoint: str, seconds: float, status: int | None) -> None:
+        with self._lock:
+            self.samples.setdefault(endpoint, []).append(seconds)
+            key = str(status) if status is not None else "error"
+            counts = self.statuses.setdefault(endpoint, {})
+            counts[key] = counts.get(key, 0) + 1
+            if status is None or status >= 500:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    k = max(0, min(len(sorted_values) - 1, int(round(q / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[k]
+
+
+class Client:
+    """One keep-alive connection, reopened whenever the server closes it."""
+
+    def __init__(self, host: str, port: int, recorder: Recorder):
+        self.host = host
+        self.port = port
+        self.recorder = recorder
+        self.conn = None
+
+    def request(self, method: str, path: str, body: bytes | None = None,
+                content_type: str = "application/json") -> tuple[int | None, bytes]:
+        endpoint = path.split("?", 1)[0]
+        headers = {"Accept-Encoding": "gzip"}
+        if body is not None:
+            headers["Content-Type"] = content_type
+        started = time.perf_counter()
+        status, data = None, b""
+        for attempt in range(2):
+            sent = False
+            try:
+                if self.conn is None:
+                    self.conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+                self.conn.request(method, path, body=body, headers=headers)
+                sent = True
+                resp = self.conn.getresponse()
+                data = resp.read()
+                status = resp.status
+                if resp.will_close:
+                    self.conn.close()
+                    self.conn = None
+                break
+            except (http.client.HTTPException, OSError):
+                if self.conn is not None:
+                    self.conn.close()
+                self.conn = None
+                status = None
+                # A kept-alive socket the server already dropped: retry once,
+                # unless a write may have been applied already.
+                if sent and method not in ("GET", "HEAD"):
+                    break
+        self.recorder.add(endpoint, time.perf_counter() - started, status)
+        return status, data
+
+    def get(self, path: str):
+        return self.request("GET", path)
+
+    def post(self, path: str, payload: dict):
+        return self.request("POST", path, json.dumps(payload).encode("utf-8"))
+
+
+class Player(threading.Thread):
+    def __init__(self, name: str, others: list[str], host: str, port: int, recorder: Recorder,
+                 ticks: "TickClock", stop: threading.Event, rng: random.Random, burst_chance: float):
+        super().__init__(name=f"player-{name}", daemon=True)
+        self.username = name
+        self.others = others
+        self.client = Client(host, port, recorder)
+        self.ticks = ticks
+        self.stop_event = stop
+        self.rng = rng
+        self.burst_chance = burst_chance
+        self.symbol = rng.choice(SYMBOLS)
+        self.owned = []
+        self.polls = STOCK_PAGE_POLLS if rng.random() < STOCK_PAGE_SHARE else DASHBOARD_POLLS
+        self.waiter = None
+
+    def run(self) -> None:
+        if self.polls is DASHBOARD_POLLS:
+            self.waiter = threading.Thread(target=self.long_poll, name=f"{self.name}-wait", daemon=True)
+            self.waiter.start()
+        now = time.monotonic()
+        # Stagger the first poll so players don't start in lockstep.
+        next_due = [now + self.rng.uniform(0, interval) for interval, _ in self.polls]
+        seen_tick = self.ticks.generation
+        burst_at = None
+
+        while not self.stop_event.is_set():
+            now = time.monotonic()
+            if self.ticks.generation != seen_tick:
+                seen_tick = self.ticks.generation
+                if self.rng.random() < self.burst_chance:
+                    # People notice the new prices within a second or so.
+                    burst_at = now + self.rng.uniform(0.0, 1.5)
+            if burst_at is not None and now >= burst_at:
+                burst_at = None
+                self.trade_burst()
+
+            for i, (interval, template) in enumerate(self.polls):
+                if now >= next_due[i]:
+                    self.client.get(template.format(u=quote(self.username), s=self.symbol))
+                    next_due[i] = now + interval
+
+            wake = min(next_due + ([burst_at] if burst_at is not None else []))
+            self.stop_event.wait(max(0.0, min(0.25, wake - time.monotonic())))
+
+    def long_poll(self) -> None:
+        """populate.js's /wait_tick loop: reload the dashboard whenever the clock moves."""
+        client = Client(self.client.host, self.client.port, self.client.recorder)
+        since = -1
+        while not self.stop_event.is_set():
+            status, data = client.get(f"/wait_tick?since={since}&timeout=5&username={quote(self.username)}")
+            if status != 200:
+                self.stop_event.wait(1.0)
+                continue
+            reply = json.loads(data)
+            if reply.get("changed") and not self.stop_event.is_set():
+                since = reply["time"]
+                client.get(DASHBOARD_POLLS[0][1].format(u=quote(self.username), s=self.symbol))
+
+    def trade_burst(self) -> None:
+        for _ in range(self.rng.randint(1, 3)):
+            r = self.rng.random()
+            if r < 0.5 or (r < 0.85 and not self.owned):
+                symbol = self.rng.choice(SYMBOLS)
+                status, _ = self.client.post("/buy", {"username": self.username, "symbol": symbol,
+                                                      "qty": self.rng.randint(1, 5)})
+                if status == 200:
+                    self.owned.append(symbol)
+            elif r < 0.85:
+                # Sell one share of something bought earlier in the run.
+                symbol = self.owned.pop(self.rng.randrange(len(self.owned)))
+                self.client.post("/sell", {"username": self.username, "symbol": symbol, "qty": 1})
+            else:
+                self.client.post("/transfer", {"from": self.username, "to": self.rng.choice(self.others),
+                                               "amount": self.rng.randint(1, 50)})
+
+
+class TickClock(threading.Thread):
+    """Advances the game like the game master's admin.sh tick."""
+
+    def __init__(self, host: str, port: int, recorder: Recorder, every: float, stop: threading.Event):
+        super().__init__(name="ticker", daemon=True)
+        self.client = Client(host, port, recorder)
+        self.every = every
+        self.stop_event = stop
+        self.generation = 0
+
+    def run(self) -> None:
+        while not self.stop_event.wait(self.every):
+            self.client.post("/admin", {"cmd": "inc_time", "step": 1})
+            self.generation += 1
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(args, data_dir: Path, port: int) -> subprocess.Popen:
+    cmd = [sys.executable, str(Path(__file__).resolve().parent / "server.py"),
+           "--host", "127.0.0.1", "--port", str(port), "--data-dir", str(data_dir),
+           "--pool-size", str(args.pool_size)]
+    if args.use_async:
+        cmd += ["--async", "--workers", str(args.workers)]
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL if args.quiet else None)
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"server exited during startup (code {proc.returncode})")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise SystemExit("server did not start listening within 30s")
+
+
+def setup_players(host: str, port: int, count: int, balance: int) -> list[str]:
+    client = Client(host, port, Recorder())
+    names = [f"bench{i:04d}" for i in range(count)]
+    for name in names:
+        client.request("POST", "/register", f"username={name}".encode(), "application/x-www-form-urlencoded")
+        client.post("/admin", {"cmd": "set_balance", "username": name, "balance": balance})
+    return names
+
+
+def report(recorder: Recorder, elapsed: float, config: dict) -> dict:
+    endpoints = {}
+    total = 0
+    for endpoint in sorted(recorder.samples):
+        values = sorted(recorder.samples[endpoint])
+        total += len(values)
+        endpoints[endpoint] = {
+            "count": len(values),
+            "errors": recorder.errors.get(endpoint, 0),
+            "statuses": recorder.statuses.get(endpoint, {}),
+            "rps": round(len(values) / elapsed, 2),
+            "mean_ms": round(sum(values) / len(values) * 1000, 3),
+            "p50_ms": round(percentile(values, 50) * 1000, 3),
+            "p95_ms": round(percentile(values, 95) * 1000, 3),
+            "p99_ms": round(percentile(values, 99) * 1000, 3),
+            "max_ms": round(values[-1] * 1000, 3),
+        }
+    return {
+        "config": config,
+        "elapsed_s": round(elapsed, 3),
+        "requests": total,
+        "errors": sum(recorder.errors.values()),
+        "throughput_rps": round(total / elapsed, 2),
+        "endpoints": endpoints,
+    }
+
+
+def print_table(result: dict) -> None:
+    out = sys.stderr
+    print(f"{result['requests']} requests in {result['elapsed_s']}s "
+          f"({result['throughput_rps']} req/s, {result['errors']} errors)", file=out)
+    print(f"{'endpoint':<16}{'count':>8}{'err':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}", file=out)
+    for endpoint, e in result["endpoints"].items():
+        print(f"{endpoint:<16}{e['count']:>8}{e['errors']:>6}{e['p50_ms']:>10}{e['p95_ms']:>10}"
+              f"{e['p99_ms']:>10}{e['max_ms']:>10}", file=out)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Mega Monopoly 5 load test")
+    parser.add_argument("--players", type=int, default=30, help="simulated phones (default: %(default)s)")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds to run (default: %(default)s)")
+    parser.add_argument("--tick-every", type=float, default=5.0,
+                        help="seconds between inc_time ticks (default: %(default)s)")
+    parser.add_argument("--burst-chance", type=float, default=0.5,
+                        help="chance a player trades after each tick (default: %(default)s)")
+    parser.add_argument("--balance", type=int, default=100000, help="starting cash per player")
+    parser.add_argument("--seed", type=int, default=None, help="seed for the players' choices")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="run the server with --async")
+    parser.add_argument("--workers", type=int, default=16, help="server --workers in --async mode")
+    parser.add_argument("--pool-size", type=int, default=8, help="server --pool-size")
+    parser.add_argument("--port", type=int, default=None,
+                        help="benchmark an already running server on this port instead of starting one")
+    parser.add_argument("--out", type=Path, default=None, help="write the JSON report here instead of stdout")
+    parser.add_argument("--quiet", action="store_true", help="hide the server's request log")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    host = "127.0.0.1"
+    proc = None
+    tmp = None
+    if args.port is None:
+        tmp = tempfile.TemporaryDirectory(prefix="mm5-bench-")
+        port = free_port()
+        proc = start_server(args, Path(tmp.name), port)
+    else:
+        port = args.port
+
+    try:
+        names = setup_players(host, port, max(2, args.players), args.balance)
+        recorder = Recorder()
+        stop = threading.Event()
+        ticks = TickClock(host, port, recorder, args.tick_every, stop)
+        players = [
+            Player(name, [n for n in names if n != name], host, port, recorder, ticks, stop,
+                   random.Random(rng.random()), args.burst_chance)
+            for name in names[:args.players]
+        ]
+
+        started = time.monotonic()
+        ticks.start()
+        for p in players:
+            p.start()
+        stop.wait(args.duration)
+        stop.set()
+        for p in players:
+            p.join(timeout=35)
+        ticks.join(timeout=35)
+        elapsed = time.monotonic() - started
+        # Parked long-polls finish within their timeout; don't kill the server under them.
+        for p in players:
+            if p.waiter is not None:
+                p.waiter.join(timeout=35)
+    finally:
+        if proc is not None:
+            proc.terminate()
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        if tmp is not None:
+            tmp.cleanup()
+
+    config = {
+        "players": args.players,
+        "duration_s": args.duration,
+        "tick_every_s": args.tick_every,
+        "burst_chance": args.burst_chance,
+        "front_end": "async" if args.use_async else "threaded",
+        "workers": args.workers if args.use_async else None,
+        "pool_size": args.pool_size,
+        "seed": args.seed,
+        "python": sys.version.split()[0],
+        "cpus": os.cpu_count(),
+    }
+    result = report(recorder, elapsed, config)
+    print_table(result)
+    text = json.dumps(result, indent=2)
+    if args.out is not None:
+        args.out.write_text(text + "\n", encoding="utf-8")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
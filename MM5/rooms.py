@@ -0,0 +1,405 @@
+"""Host several games at once, one server.py worker process per game.
+
+    python rooms.py --games monday friday
+    python rooms.py --games monday friday --async --port 8888
+
+Each game keeps its own users.db/news.db under --games-dir/<game>, its own
+clock and its own market, in its own worker process listening on loopback,
+so one table's tick never waits on another table's GIL or SQLite lock.
+This process is only the front: it reads request heads, picks the game and
+relays bytes to that game's worker. It restarts a worker that dies, and the
+worker resumes from its last committed tick.
+
+The game comes from, in order: ?game=<id> (which also sets the mm_game
+cookie, so the rest of the session follows), an X-MM-Game header (admin.sh
+sends GAME=<id>), the mm_game cookie, and otherwise the first game listed.
+GET /games lists the games for the join page.
+"""
+
+import argparse
+import asyncio
+import json
+import re
+import signal
+import socket
+import subprocess
+import sys
+from http import HTTPStatus
+from http.cookies import CookieError, SimpleCookie
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+
+SERVER = Path(__file__).resolve().parent / "server.py"
+
+GAME_ID = re.compile(r"^[a-z0-9][a-z0-9_-]{0,31}$")
+GAME_COOKIE = "mm_game"
+GAME_HEADER = "X-MM-Game"
+COOKIE_MAX_AGE = 7 * 24 * 3600
+
+KEEPALIVE_TIMEOUT = 75
+MAX_HEADERS = 100
+# Idle keep-alive connections kept open to each --async worker.
+UPSTREAM_IDLE = 16
+WORKER_START_TIMEOUT = 30
+RELAY_CHUNK = 64 * 1024
+# Never passed through: they describe one hop, not the request.
+HOP_BY_HOP = {"connection", "keep-alive", "proxy-connection", "te", "trailer", "upgrade", "x-forwarded-for"}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class Room:
+    """One game: its data directory and the server.py process serving it."""
+
+    def __init__(self, game_id: str, data_dir: Path, worker_args: list[str]):
+        self.id = game_id
+        self.data_dir = data_dir
+        self.worker_args = worker_args
+        self.port = None
+        self.proc = None
+        self.idle = []
+
+    def start(self) -> None:
+        self.data_dir.mkdir(parents=True, exist_ok=True)
+        self.port = free_port()
+        self.close_idle()
+        cmd = [sys.executable, str(SERVER), "--host", "127.0.0.1", "--port", str(self.port),
+               "--data-dir", str(self.data_dir), "--behind-front", *self.worker_args]
+        # Own session, so Ctrl-C reaches the front only and it stops workers in order.
+        self.proc = subprocess.Popen(cmd, start_new_session=True)
+
+    async def wait_ready(self) -> bool:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + WORKER_START_TIMEOUT
+        while loop.time() < deadline and self.running:
+            try:
+                _, writer = await asyncio.open_connection("127.0.0.1", self.port)
+            except OSError:
+                await asyncio.sleep(0.05)
+                continue
+            writer.close()
+            return True
+        return False
+
+    @property
+    def running(self) -> bool:
+        return self.proc is not None and self.proc.poll() is None
+
+    async def connect(self) -> tuple[asyncio.StreamReader, asyncio.StreamWriter, bool]:
+        """A connection to the worker, reusing an idle one if there is one; the flag says which."""
+        while self.idle:
+            reader, writer = self.idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer, True
+            writer.close()
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        return reader, writer, False
+
+    def release(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        if len(self.idle) < UPSTREAM_IDLE and not writer.is_closing():
+            self.idle.append((reader, writer))
+        else:
+            writer.close()
+
+    def close_idle(self) -> None:
+        for _, writer in self.idle:
+            writer.close()
+        self.idle.clear()
+
+    def stop(self) -> None:
+        if self.running:
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+
+
+async def read_head(reader: asyncio.StreamReader, timeout: float | None = None):
+    """(first line parts, [(name, value)]) of the next message, or None at end of stream."""
+    try:
+        line = await asyncio.wait_for(reader.readline(), timeout)
+    except asyncio.TimeoutError:
+        return None
+    while line in (b"\r\n", b"\n"):
+        line = await reader.readline()
+    if not line:
+        return None
+    first = line.decode("latin-1").rstrip("\r\n").split(" ", 2)
+    headers = []
+    for _ in range(MAX_HEADERS):
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            return first, headers
+        name, _, value = line.decode("latin-1").partition(":")
+        headers.append((name.strip(), value.strip()))
+    raise ValueError("too many headers")
+
+
+def header(headers: list[tuple[str, str]], name: str) -> str | None:
+    name = name.lower()
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+
+def encode_head(first: str, headers: list[tuple[str, str]]) -> bytes:
+    lines = [first] + [f"{name}: {value}" for name, value in headers]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+class Front:
+    """asyncio front-end that routes each request to its game's worker."""
+
+    def __init__(self, rooms: dict[str, Room], default: str):
+        self.rooms = rooms
+        self.default = default
+        self.connections = set()
+
+    async def serve(self, host: str, port: int) -> None:
+        await asyncio.gather(*(self.launch(room) for room in self.rooms.values()))
+        server = await asyncio.start_server(self.handle_connection, host, port, backlog=1024)
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        watchdog = asyncio.create_task(self.watch())
+        print(f"Serving {len(self.rooms)} games on http://{host}:{port}: "
+              + ", ".join(f"{room.id} (port {room.port})" for room in self.rooms.values()))
+        try:
+            await stop.wait()
+        finally:
+            server.close()
+            watchdog.cancel()
+            # Open streams and parked long-polls would otherwise hold shutdown up.
+            for task in list(self.connections):
+                task.cancel()
+            await asyncio.gather(watchdog, *self.connections, return_exceptions=True)
+            for room in self.rooms.values():
+                room.close_idle()
+
+    async def launch(self, room: Room) -> None:
+        room.start()
+        if not await room.wait_ready():
+            print(f"rooms: game {room.id} did not start", file=sys.stderr)
+
+    async def watch(self) -> None:
+        """Restart any worker that exits; it picks up from its last committed tick."""
+        while True:
+            await asyncio.sleep(1.0)
+            for room in self.rooms.values():
+                if not room.running:
+                    code = room.proc.returncode if room.proc is not None else None
+                    print(f"rooms: game {room.id} worker exited ({code}), restarting", file=sys.stderr)
+                    await self.launch(room)
+
+    def close(self) -> None:
+        for room in self.rooms.values():
+            room.stop()
+
+    def pick(self, target: str, headers: list[tuple[str, str]]) -> tuple[str, bool]:
+        """The game id for a request, and whether to (re)set the cookie."""
+        query = parse_qs(urlsplit(target).query)
+        if query.get("game"):
+            return query["game"][0].strip().lower(), True
+        explicit = header(headers, GAME_HEADER)
+        if explicit:
+            return explicit.strip().lower(), False
+        raw = header(headers, "Cookie")
+        if raw:
+            try:
+                cookie = SimpleCookie(raw)
+            except CookieError:
+                cookie = {}
+            if GAME_COOKIE in cookie:
+                return cookie[GAME_COOKIE].value.strip().lower(), False
+        return self.default, False
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        peer = writer.get_extra_info("peername")
+        client_ip = peer[0] if peer else ""
+        task = asyncio.current_task()
+        self.connections.add(task)
+        try:
+            while True:
+                head = await read_head(reader, KEEPALIVE_TIMEOUT)
+                if head is None or len(head[0]) != 3:
+                    break
+                (method, target, version), headers = head
+                if header(headers, "Transfer-Encoding"):
+                    self.reply(writer, 411, {"ok": False, "error": "Content-Length required"}, False)
+                    await writer.drain()
+                    break
+                length = int(header(headers, "Content-Length") or 0)
+                body = await reader.readexactly(length) if length > 0 else b""
+
+                connection = (header(headers, "Connection") or "").lower()
+                keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+                if not await self.forward(method, target, headers, body, client_ip, keep_alive, writer):
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            pass
+        except asyncio.CancelledError:
+            # Shutdown; finishing normally keeps asyncio's stream callback from logging it.
+            pass
+        finally:
+            self.connections.discard(task)
+            writer.close()
+
+    def reply(self, writer: asyncio.StreamWriter, status: int, payload: dict, keep_alive: bool,
+              extra: list | None = None) -> None:
+        body = json.dumps(payload).encode("utf-8")
+        headers = [("Content-Type", "application/json; charset=utf-8"), ("Cache-Control", "no-cache"),
+                   *(extra or []), ("Content-Length", str(len(body))),
+                   ("Connection", "keep-alive" if keep_alive else "close")]
+        writer.write(encode_head(f"HTTP/1.1 {status} {HTTPStatus(status).phrase}", headers) + body)
+
+    async def forward(self, method: str, target: str, headers: list, body: bytes, client_ip: str,
+                      keep_alive: bool, writer: asyncio.StreamWriter) -> bool:
+        """Relay one request to its game; returns whether the client connection stays open."""
+        game_id, set_cookie = self.pick(target, headers)
+        extra = []
+        if set_cookie and GAME_ID.match(game_id):
+            extra.append(("Set-Cookie", f"{GAME_COOKIE}={game_id}; Path=/; Max-Age={COOKIE_MAX_AGE}; SameSite=Lax"))
+
+        if urlsplit(target).path == "/games" and method in ("GET", "HEAD"):
+            games = [{"id": room.id, "up": room.running} for room in self.rooms.values()]
+            current = game_id if game_id in self.rooms else self.default
+            self.reply(writer, 200, {"ok": True, "games": games, "current": current}, keep_alive, extra)
+            await writer.drain()
+            return keep_alive
+
+        room = self.rooms.get(game_id)
+        if room is None:
+            self.reply(writer, 404, {"ok": False, "error": f"unknown game: {game_id}"}, keep_alive)
+            await writer.drain()
+            return keep_alive
+
+        request_headers = [(k, v) for k, v in headers if k.lower() not in HOP_BY_HOP]
+        request_headers += [("X-Forwarded-For", client_ip), ("Connection", "keep-alive")]
+        request = encode_head(f"{method} {target} HTTP/1.1", request_headers) + body
+
+        while True:
+            try:
+                up_reader, up_writer, reused = await room.connect()
+            except OSError:
+                self.reply(writer, 502, {"ok": False, "error": f"game {game_id} is not running"}, False)
+                await writer.drain()
+                return False
+            try:
+                up_writer.write(request)
+                await up_writer.drain()
+            except ConnectionError:
+                up_writer.close()
+                if reused:
+                    # An idle keep-alive connection the worker had already closed: try the next one.
+                    continue
+                self.reply(writer, 502, {"ok": False, "error": f"game {game_id} is not running"}, False)
+                await writer.drain()
+                return False
+            try:
+                response = await read_head(up_reader)
+            except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+                response = None
+            if response is not None:
+                break
+            up_writer.close()
+            # The worker may have applied it already: only reads are safe to send
+            # again, and a trade or tick is left for the client to retry.
+            if not reused or method not in ("GET", "HEAD"):
+                self.reply(writer, 502, {"ok": False, "error": f"game {game_id} dropped the request"}, False)
+                await writer.drain()
+                return False
+
+        (_, status, *_), response_headers = response
+        status = int(status)
+        upstream_close = (header(response_headers, "Connection") or "").lower() == "close"
+        length = header(response_headers, "Content-Length")
+        no_body = method == "HEAD" or status in (204, 304) or 100 <= status < 200
+        streaming = not no_body and length is None
+
+        out_headers = [(k, v) for k, v in response_headers if k.lower() not in HOP_BY_HOP] + extra
+        keep_alive = keep_alive and not streaming
+        out_headers.append(("Connection", "keep-alive" if keep_alive else "close"))
+        writer.write(encode_head(f"HTTP/1.1 {status} {HTTPStatus(status).phrase}", out_headers))
+
+        try:
+            if streaming:
+                # /stream and anything else delimited by closing the connection.
+                while chunk := await up_reader.read(RELAY_CHUNK):
+                    writer.write(chunk)
+                    await writer.drain()
+                up_writer.close()
+                return False
+            remaining = 0 if no_body else int(length)
+            while remaining > 0:
+                chunk = await up_reader.read(min(remaining, RELAY_CHUNK))
+                if not chunk:
+                    raise ConnectionError("worker closed mid-response")
+                writer.write(chunk)
+                remaining -= len(chunk)
+            await writer.drain()
+        except BaseException:
+            up_writer.close()
+            raise
+
+        if upstream_close:
+            up_writer.close()
+        else:
+            room.release(up_reader, up_writer)
+        return keep_alive
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Mega Monopoly 5: several games, one worker process each")
+    parser.add_argument("--games", nargs="*", default=None,
+                        help="game ids to host (default: every directory in --games-dir, or 'main')")
+    parser.add_argument("--games-dir", type=Path, default=Path(__file__).resolve().parent / "games",
+                        help="one sub-directory of databases per game (default: %(default)s)")
+    parser.add_argument("--host", default="0.0.0.0", help="address to listen on (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=8888, help="port to listen on (default: %(default)s)")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="run each worker with server.py --async")
+    parser.add_argument("--workers", type=int, default=None, help="server.py --workers for each --async worker")
+    parser.add_argument("--pool-size", type=int, default=None, help="server.py --pool-size for each worker")
+    parser.add_argument("--dev", action="store_true", help="server.py --dev for each worker")
+    args = parser.parse_args()
+
+    games = args.games
+    if not games:
+        found = sorted(p.name for p in args.games_dir.iterdir() if p.is_dir()) if args.games_dir.is_dir() else []
+        games = [g for g in found if GAME_ID.match(g)] or ["main"]
+    games = [g.lower() for g in games]
+    bad = [g for g in games if not GAME_ID.match(g)]
+    if bad:
+        raise SystemExit(f"invalid game id(s): {', '.join(bad)} (use a-z, 0-9, '-' and '_', up to 32 chars)")
+    if len(set(games)) != len(games):
+        raise SystemExit("duplicate game ids")
+
+    worker_args = []
+    if args.use_async:
+        worker_args.append("--async")
+        if args.workers is not None:
+            worker_args += ["--workers", str(args.workers)]
+    if args.pool_size is not None:
+        worker_args += ["--pool-size", str(args.pool_size)]
+    if args.dev:
+        worker_args.append("--dev")
+
+    rooms = {g: Room(g, args.games_dir / g, worker_args) for g in games}
+    front = Front(rooms, games[0])
+    try:
+        asyncio.run(front.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        front.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,31 +1,177 @@
-import os
 import sqlite3
 import json
+import queue
 import random
-from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+import threading
+import time
+import argparse
+import asyncio
+import bisect
+import email.message
+import gzip
+import hashlib
+import heapq
+import mimetypes
+import secrets
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from http import HTTPStatus
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from pathlib import Path
-from urllib.parse import urlparse, parse_qs, quote
+from urllib.parse import urlparse, parse_qs, quote, unquote
 from urllib.parse import parse_qs as _parse_qs
 
+try:
+    import numpy as np
+except ImportError:  # optional; the tick engine falls back to plain Python
+    np = None
+
 DB_NAME = "users.db"
 NEWS_DB_NAME = "news.db"
 NEWS_EVENTS_FILE = "news_events.json"
 
 TIME = 0
+# Per-tick volatility of the baseline random walk, and the floor prices can't drop below.
+TICK_SIGMA = 0.015
+MIN_PRICE = 0.01
+# Distinguishes this process's ETags from a previous run's: the clock now
+# survives restarts, but a wiped or swapped data directory replays the same
+# tick numbers with different prices.
+BOOT_ID = secrets.token_hex(4)
+# Set by --behind-front: this process is a rooms.py worker, reachable only on
+# loopback, and the front passes the real client address in X-Forwarded-For.
+TRUST_FORWARDED = False
+
+# Connections kept open per database by the server. Handler threads borrow one
+# for the duration of a request instead of opening the file every time.
+DB_POOL_SIZE = 8
+# Per-connection prepared statement cache (sqlite3's LRU of compiled SQL).
+DB_STATEMENT_CACHE = 256
+# Most queued mutations the writer thread folds into one transaction.
+WRITER_MAX_BATCH = 64
+# --async front-end: threads running blocking endpoint/SQLite work, seconds an
+# idle keep-alive connection is held, and the most header lines accepted.
+ASYNC_WORKERS = 16
+KEEPALIVE_TIMEOUT = 75
+MAX_HEADERS = 100
+# Static assets: seconds browsers may reuse scripts/styles/images without
+# asking, the smallest file worth gzipping, and which types get gzipped.
+STATIC_MAX_AGE = 600
+STATIC_GZIP_MIN = 256
+# Dynamic responses are gzipped when at least this big and the client accepts it.
+# Below that, compression costs more CPU than it saves on the wire.
+RESPONSE_GZIP_MIN = 1024
+RESPONSE_GZIP_LEVEL = 5
+STATIC_COMPRESSIBLE = {"text/html", "text/css", "application/javascript", "text/javascript",
+                       "application/json", "image/svg+xml", "image/vnd.microsoft.icon", "image/x-icon"}
+# Candle widths kept in stock_candles, in ticks: a year, five years, 25 years.
+CANDLE_BUCKETS = (4, 20, 100)
+# Ticks between a cash-out request and the money leaving the game (a year).
+CASHOUT_DELAY = 4
+# Most legs one POST /orders batch may carry.
+ORDER_BATCH_MAX = 50
+# A balance snapshot is written at the end of any tick batch that crosses a
+# multiple of this, so reconstructing a balance replays at most that many
+# ticks of ledger rows.
+LEDGER_SNAPSHOT_EVERY = 20
+# Share of every pari-mutuel pool kept by the house (0 = winners split it all).
+BET_RAKE = 0.0
+# Only the last few turns of a multi-step inc_time are pushed to /stream as news.
+NEWS_PUSH_TURNS = 4
+# Sections /dashboard can return; ?fields= picks a subset.
+DASHBOARD_FIELDS = ("user", "users", "stocks", "holdings", "news")
+# Events buffered per /stream client before it starts missing them.
+STREAM_QUEUE_SIZE = 64
+# Seconds of silence before a /stream gets a keepalive comment.
+STREAM_KEEPALIVE = 15
+# /wait_tick holds a request at most this long (seconds) before answering
+# "no change"; kept under the usual 60s proxy/browser idle timeouts.
+WAIT_TICK_TIMEOUT = 25
+WAIT_TICK_MAX = 55
+# How long a coalesced GET response may be reused. Entries are also keyed by
+# TIME (and, for user data, the writer's commit count), so this only bounds
+# memory and how long an identical burst shares one answer.
+COALESCE_TTL = 1.0
+COALESCE_MAX_KEYS = 512
+# Histogram bucket upper bounds (seconds) for /metrics.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+TICK_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def open_db(db_path) -> sqlite3.Connection:
+    """Open a long-lived connection tuned for many small concurrent reads.
+
+    WAL lets readers carry on while a trade or tick is writing, and
+    synchronous=NORMAL is durable enough in WAL mode without an fsync per commit.
+    """
+    conn = sqlite3.connect(
+        db_path,
+        timeout=5.0,
+        check_same_thread=False,
+        cached_statements=DB_STATEMENT_CACHE,
+    )
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-8000")
+    conn.execute("PRAGMA mmap_size=67108864")
+    return conn
+
+
+class ConnectionPool:
+    """Fixed-size pool of open connections to one database file.
+
+    ThreadingHTTPServer starts a fresh thread per client connection, so
+    thread-local connections would be thrown away with the thread. Instead the
+    server owns the connections and each request borrows one. Connections are
+    opened lazily and handed out LIFO so the warmest ones get reused.
+    """
 
+    def __init__(self, db_path, size: int = DB_POOL_SIZE):
+        self.db_path = str(db_path)
+        self.size = max(1, int(size))
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
 
-def is_localhost(handler) -> bool:
-    ip = handler.client_address[0]
-    return ip == "127.0.0.1" or ip == "::1"
-
+    def _acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._opened < self.size:
+                self._opened += 1
+                try:
+                    return open_db(self.db_path)
+                except Exception:
+                    self._opened -= 1
+                    raise
+        return self._idle.get()
+
+    def _release(self, conn: sqlite3.Connection) -> None:
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        started = time.perf_counter()
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self._release(conn)
+            charge_request(DB_TIME, time.perf_counter() - started)
 
-def read_json_body(handler) -> dict:
-    length = int(handler.headers.get("Content-Length", "0"))
-    raw = handler.rfile.read(length) if length > 0 else b"{}"
-    try:
-        return json.loads(raw.decode("utf-8"))
-    except Exception:
-        return {}
+    def close(self) -> None:
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
 
 
 def init_users_db(db_path: Path) -> None:
@@ -95,7 +241,7 @@ def init_stock_prices_db(db_path: Path) -> None:
                 price REAL NOT NULL,
                 PRIMARY KEY (symbol, time),
                 FOREIGN KEY (symbol) REFERENCES stocks(symbol)
-            )
+            ) WITHOUT ROWID
             """
         )
         conn.commit()
@@ -103,6 +249,36 @@ def init_stock_prices_db(db_path: Path) -> None:
         conn.close()
 
 
+def init_stock_candles_db(db_path: Path) -> None:
+    """OHLC rollups of stock_prices: (symbol,bucket,start)->open,high,low,close.
+
+    `bucket` is the candle width in ticks and `start` the first tick it
+    covers. Rebuilt from stock_prices when the table is first created.
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS stock_candles (
+                symbol TEXT NOT NULL,
+                bucket INTEGER NOT NULL,
+                start INTEGER NOT NULL,
+                open REAL NOT NULL,
+                high REAL NOT NULL,
+                low REAL NOT NULL,
+                close REAL NOT NULL,
+                PRIMARY KEY (symbol, bucket, start)
+            ) WITHOUT ROWID
+            """
+        )
+        if conn.execute("SELECT 1 FROM stock_candles LIMIT 1").fetchone() is None:
+            history = conn.execute("SELECT symbol, time, price FROM stock_prices ORDER BY symbol, time")
+            write_candles(conn, history)
+        conn.commit()
+    finally:
+        conn.close()
+
+
 def init_holdings_db(db_path: Path) -> None:
     """User holdings: (username,symbol)->shares."""
     conn = sqlite3.connect(db_path)
@@ -124,6 +300,227 @@ def init_holdings_db(db_path: Path) -> None:
         conn.close()
 
 
+def _users_v1(conn: sqlite3.Connection) -> None:
+    # Holdings lookups by user are answered from the index alone.
+    conn.execute("CREATE INDEX IF NOT EXISTS holdings_by_user ON holdings(username, symbol, shares)")
+    # stock_prices is only ever read by (symbol, time): store the rows in that
+    # key's b-tree instead of a rowid table plus a separate primary-key index.
+    sql = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'stock_prices'").fetchone()[0]
+    if "WITHOUT ROWID" not in sql.upper():
+        conn.execute("ALTER TABLE stock_prices RENAME TO stock_prices_rowid")
+        conn.execute(
+            """
+            CREATE TABLE stock_prices (
+                symbol TEXT NOT NULL,
+                time INTEGER NOT NULL,
+                price REAL NOT NULL,
+                PRIMARY KEY (symbol, time),
+                FOREIGN KEY (symbol) REFERENCES stocks(symbol)
+            ) WITHOUT ROWID
+            """
+        )
+        conn.execute("INSERT INTO stock_prices(symbol, time, price) SELECT symbol, time, price FROM stock_prices_rowid")
+        conn.execute("DROP TABLE stock_prices_rowid")
+
+
+def _users_v2(conn: sqlite3.Connection) -> None:
+    # Cash plus holdings at current prices, one row per user, kept current by
+    # the trade ops and by each tick so /leaderboard never has to join.
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS net_worth (
+            username TEXT PRIMARY KEY,
+            cash INTEGER NOT NULL,
+            holdings_value REAL NOT NULL,
+            net_worth REAL NOT NULL,
+            FOREIGN KEY (username) REFERENCES users(username)
+        ) WITHOUT ROWID
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS net_worth_rank ON net_worth(net_worth DESC, username)")
+    conn.execute(NET_WORTH_UPSERT.format(where="", where_user=""))
+
+
+def _users_v3(conn: sqlite3.Connection) -> None:
+    # Limit/stop orders. Open ones are mirrored in memory by OrderBook.
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL,
+            symbol TEXT NOT NULL,
+            side TEXT NOT NULL CHECK (side IN ('buy', 'sell')),
+            kind TEXT NOT NULL CHECK (kind IN ('limit', 'stop')),
+            qty INTEGER NOT NULL,
+            price REAL NOT NULL,
+            placed_time INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'open',
+            note TEXT,
+            fill_price REAL,
+            fill_time INTEGER,
+            FOREIGN KEY (username) REFERENCES users(username),
+            FOREIGN KEY (symbol) REFERENCES stocks(symbol)
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS orders_by_user ON orders(username, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS orders_open ON orders(id) WHERE status = 'open'")
+
+
+def _users_v4(conn: sqlite3.Connection) -> None:
+    # Sports betting: markets, their outcomes (with odds for fixed-odds
+    # markets) and the bets. Open pools are mirrored in memory by BettingPools.
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS bet_markets (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            kind TEXT NOT NULL CHECK (kind IN ('parimutuel', 'fixed')),
+            status TEXT NOT NULL DEFAULT 'open',
+            winner TEXT,
+            created_time INTEGER NOT NULL,
+            settled_time INTEGER
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS bet_outcomes (
+            market_id INTEGER NOT NULL,
+            outcome TEXT NOT NULL,
+            odds REAL,
+            PRIMARY KEY (market_id, outcome),
+            FOREIGN KEY (market_id) REFERENCES bet_markets(id)
+        ) WITHOUT ROWID
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS bets (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            market_id INTEGER NOT NULL,
+            username TEXT NOT NULL,
+            outcome TEXT NOT NULL,
+            stake INTEGER NOT NULL,
+            odds REAL,
+            placed_time INTEGER NOT NULL,
+            payout INTEGER,
+            FOREIGN KEY (market_id) REFERENCES bet_markets(id),
+            FOREIGN KEY (username) REFERENCES users(username)
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS bets_by_market ON bets(market_id, username, payout)")
+    conn.execute("CREATE INDEX IF NOT EXISTS bets_by_user ON bets(username, id)")
+
+
+def _users_v5(conn: sqlite3.Connection) -> None:
+    # Cash-outs: the amount leaves the balance when requested and is paid out
+    # at due_time unless cancelled first. Pending ones sit in Game.cashouts.
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS withdrawals (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL,
+            amount INTEGER NOT NULL,
+            requested_time INTEGER NOT NULL,
+            due_time INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            released_time INTEGER,
+            FOREIGN KEY (username) REFERENCES users(username)
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS withdrawals_by_user ON withdrawals(username, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS withdrawals_pending ON withdrawals(due_time) WHERE status = 'pending'")
+
+
+def _users_v6(conn: sqlite3.Connection) -> None:
+    # Append-only journal of every cash and share movement, written by the
+    # op that makes it, plus periodic per-user balance snapshots. A snapshot
+    # covers every ledger row up to ledger_id.
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS ledger (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            time INTEGER NOT NULL,
+            username TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            cash_delta INTEGER NOT NULL DEFAULT 0,
+            symbol TEXT,
+            shares_delta INTEGER,
+            price REAL,
+            ref TEXT
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS ledger_by_user ON ledger(username, id, time, cash_delta)")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS balance_snapshots (
+            username TEXT NOT NULL,
+            time INTEGER NOT NULL,
+            balance INTEGER NOT NULL,
+            ledger_id INTEGER NOT NULL,
+            PRIMARY KEY (username, time)
+        ) WITHOUT ROWID
+        """
+    )
+    # Opening balances, so replays never need to go further back than this.
+    # TIME is not restored yet during upgrades; the newest price row is the
+    # game's current tick.
+    now = conn.execute("SELECT COALESCE(MAX(time), 0) FROM stock_prices").fetchone()[0]
+    snapshot_balances(conn, now)
+
+
+def _users_v7(conn: sqlite3.Connection) -> None:
+    # The game clock and RNG stream, rewritten by every tick in the same
+    # transaction as its prices, so a restart resumes exactly where the last
+    # committed tick left off.
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS game_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            time INTEGER NOT NULL,
+            rng_state TEXT
+        )
+        """
+    )
+    # Games started before the clock was saved: the newest price row is the
+    # last tick that committed.
+    conn.execute("INSERT OR IGNORE INTO game_state(id, time) SELECT 1, COALESCE(MAX(time), 0) FROM stock_prices")
+
+
+def _news_v1(conn: sqlite3.Connection) -> None:
+    # WHERE time = ? ORDER BY id: the index row carries the rowid (= id).
+    conn.execute("CREATE INDEX IF NOT EXISTS news_by_time ON news(time, id)")
+
+
+# Schema upgrades, applied in order; PRAGMA user_version counts how many ran.
+USERS_MIGRATIONS = [_users_v1, _users_v2, _users_v3, _users_v4, _users_v5, _users_v6, _users_v7]
+NEWS_MIGRATIONS = [_news_v1]
+
+
+def upgrade_schema(db_path: Path, migrations: list) -> None:
+    """Bring an existing database up to date, one transaction per step."""
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for number, step in enumerate(migrations[version:], start=version + 1):
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                step(conn)
+                conn.execute(f"PRAGMA user_version = {number}")
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        if version < len(migrations):
+            conn.execute("ANALYZE")
+    finally:
+        conn.close()
+
+
 def seed_stocks_if_empty(db_path: Path) -> None:
     stocks_seed = [
         ("AAPL", "Apple Inc.", "Tech", 184.22),
@@ -165,6 +562,46 @@ def seed_stocks_if_empty(db_path: Path) -> None:
         conn.close()
 
 
+def save_game_state(conn: sqlite3.Connection, time_value: int) -> None:
+    """Record the clock and the RNG position; call inside the tick's transaction."""
+    version, internal, gauss_next = random.getstate()
+    conn.execute(
+        "UPDATE game_state SET time = ?, rng_state = ? WHERE id = 1",
+        (int(time_value), json.dumps([version, internal, gauss_next])),
+    )
+
+
+def restore_game_state(users_db_path: Path, news_db_path: Path) -> int:
+    """Resume from the last committed tick: returns its time and rewinds `random` to it.
+
+    Reads one row, so startup costs the same however long the game has run.
+    News is written just before the market tick that uses it; headlines for
+    a tick that never committed are dropped, and the restored RNG draws the
+    same ones again.
+    """
+    conn = sqlite3.connect(users_db_path)
+    try:
+        row = conn.execute("SELECT time, rng_state FROM game_state WHERE id = 1").fetchone()
+        time_value = int(row[0]) if row else 0
+        if row and row[1]:
+            version, internal, gauss_next = json.loads(row[1])
+            random.setstate((version, tuple(internal), gauss_next))
+        else:
+            conn.execute("INSERT OR IGNORE INTO game_state(id, time) VALUES(1, ?)", (time_value,))
+            save_game_state(conn, time_value)
+            conn.commit()
+    finally:
+        conn.close()
+
+    conn = sqlite3.connect(news_db_path)
+    try:
+        conn.execute("DELETE FROM news WHERE time > ?", (time_value,))
+        conn.commit()
+    finally:
+        conn.close()
+    return time_value
+
+
 def ensure_history_at_time(db_path: Path, time_value: int) -> None:
     """Make sure every stock has a history row at time_value."""
     conn = sqlite3.connect(db_path)
@@ -204,45 +641,60 @@ def load_news_events(projroot: Path) -> list[dict]:
         return []
 
 
-def insert_news_items(news_db_path: str, time_value: int, items: list[dict]) -> None:
-    if not items:
-        return
-    conn = sqlite3.connect(news_db_path)
-    try:
-        cur = conn.cursor()
+def insert_news_items(conn: sqlite3.Connection, time_value: int, items: list[dict]) -> None:
+    insert_news_turns(conn, time_value, [items])
+
+
+def insert_news_turns(conn: sqlite3.Connection, first_time: int, turns: list[list[dict]]) -> None:
+    """Insert several consecutive turns of news (turns[k] at first_time + k) in one commit."""
+    rows = []
+    for k, items in enumerate(turns):
         for ev in items:
             headline = str(ev.get("headline", "")).strip() or "Untitled"
             body = str(ev.get("body", "")).strip() or ""
             effects = ev.get("effects") or {}
-            cur.execute(
-                "INSERT INTO news (time, headline, body, effects_json) VALUES (?, ?, ?, ?)",
-                (time_value, headline, body, json.dumps(effects)),
-            )
-        conn.commit()
-    finally:
-        conn.close()
+            rows.append((first_time + k, headline, body, json.dumps(effects)))
+    if not rows:
+        return
+    conn.executemany("INSERT INTO news (time, headline, body, effects_json) VALUES (?, ?, ?, ?)", rows)
+    conn.commit()
 
 
 def ensure_initial_news(news_db_path: str, events_bank: list[dict]) -> None:
     conn = sqlite3.connect(news_db_path)
     try:
         count = conn.execute("SELECT COUNT(*) FROM news").fetchone()[0]
+        if count > 0:
+            return
+
+        if not events_bank:
+            insert_news_items(conn, 0, [{
+                "headline": "No news bank found",
+                "body": "news_events.json is missing or invalid.",
+                "effects": {}
+            }])
+            return
+
+        seed_items = events_bank[:3]
+        insert_news_items(conn, 0, seed_items)
     finally:
         conn.close()
 
-    if count > 0:
-        return
-
-    if not events_bank:
-        insert_news_items(news_db_path, 0, [{
-            "headline": "No news bank found",
-            "body": "news_events.json is missing or invalid.",
-            "effects": {}
-        }])
-        return
 
-    seed_items = events_bank[:3]
-    insert_news_items(news_db_path, 0, seed_items)
+def news_row_to_item(row: tuple) -> dict:
+    """(time, headline, body, effects_json) row -> the JSON shape /news returns."""
+    t, headline, body, effects_json = row
+    try:
+        effects = json.loads(effects_json) if effects_json else {}
+    except Exception:
+        effects = {}
+    return {
+        "time": int(t),
+        "time_string": format_time(int(t)),
+        "headline": headline,
+        "body": body,
+        "effects": effects,
+    }
 
 
 def generate_news_for_turn(events_bank: list[dict], k_min: int = 1, k_max: int = 3) -> list[dict]:
@@ -252,35 +704,418 @@ def generate_news_for_turn(events_bank: list[dict], k_min: int = 1, k_max: int =
     return [random.choice(events_bank) for _ in range(k)]
 
 
-def tick_stock_market(users_db_path: str, news_items: list[dict], time_value: int) -> None:
-    """Advance all stock prices by one tick and append history.
+def draw_returns(n: int, mu: float = 0.0, sigma: float = TICK_SIGMA):
+    """n independent normal returns, drawn in one call.
 
-    NOTE: news integration stub, you can wire effects here once schema is final.
+    With NumPy this is a single vectorized draw. The generator is seeded from
+    the stdlib `random` stream so a game stays reproducible from one RNG.
     """
-    conn = sqlite3.connect(users_db_path)
-    try:
-        cur = conn.cursor()
-        rows = cur.execute("SELECT symbol, price FROM stocks").fetchall()
+    if np is not None:
+        return np.random.default_rng(random.getrandbits(64)).normal(mu, sigma, n)
+    gauss = random.gauss
+    return [gauss(mu, sigma) for _ in range(n)]
 
-        for sym, old_price in rows:
-            price = float(old_price)
 
-            # basic random walk for now
-            ret = random.gauss(0.0, 0.015)
-            new_price = max(0.01, price * (1.0 + ret))
+def apply_returns(prices, returns) -> list[float]:
+    """new_price = max(0.01, price * (1 + ret)) over the whole market at once."""
+    if np is not None:
+        return np.maximum(MIN_PRICE, np.asarray(prices, dtype=float) * (1.0 + np.asarray(returns))).tolist()
+    return [max(MIN_PRICE, p * (1.0 + r)) for p, r in zip(prices, returns)]
 
-            cur.execute(
-                "UPDATE stocks SET prev_price = ?, price = ? WHERE symbol = ?",
-                (price, new_price, sym),
-            )
-            cur.execute(
-                "INSERT OR REPLACE INTO stock_prices(symbol, time, price) VALUES(?,?,?)",
-                (sym, int(time_value), float(new_price)),
-            )
 
-        conn.commit()
-    finally:
-        conn.close()
+class NewsEffects:
+    """The news bank compiled into per-symbol effect vectors.
+
+    Every event's effects.stocks list becomes three dense vectors aligned to
+    `symbols`: ret_mu (added to the drift), ret_sigma_mult (scales the
+    volatility) and shock (a one-off jump). Applying a turn's news is then a
+    few row sums/products, no matter how large the bank is.
+    """
+
+    def __init__(self, events_bank: list[dict], symbols: list[str]):
+        self.symbols = list(symbols)
+        self._col = {sym: i for i, sym in enumerate(self.symbols)}
+        self._row = {}
+        mu_rows, sigma_rows, shock_rows = [], [], []
+        for ev in events_bank:
+            mu, sigma_mult, shock = self._compile(ev)
+            self._row[id(ev)] = len(mu_rows)
+            mu_rows.append(mu)
+            sigma_rows.append(sigma_mult)
+            shock_rows.append(shock)
+
+        if np is not None:
+            n = len(self.symbols)
+            self.mu = np.array(mu_rows, dtype=float).reshape(-1, n)
+            self.sigma_mult = np.array(sigma_rows, dtype=float).reshape(-1, n)
+            self.shock = np.array(shock_rows, dtype=float).reshape(-1, n)
+        else:
+            self.mu, self.sigma_mult, self.shock = mu_rows, sigma_rows, shock_rows
+
+    def _compile(self, ev: dict) -> tuple[list, list, list]:
+        n = len(self.symbols)
+        mu, sigma_mult, shock = [0.0] * n, [1.0] * n, [0.0] * n
+        effects = ev.get("effects") or {}
+        for eff in effects.get("stocks") or []:
+            i = self._col.get(str(eff.get("symbol", "")).strip().upper())
+            if i is None:
+                continue
+            try:
+                mu[i] += float(eff.get("ret_mu", 0.0))
+                sigma_mult[i] *= float(eff.get("ret_sigma_mult", 1.0))
+                shock[i] += float(eff.get("shock", 0.0))
+            except (TypeError, ValueError):
+                continue
+        return mu, sigma_mult, shock
+
+    def apply(self, returns, news_items: list[dict]):
+        """Shift a turn's baseline returns by the combined effect of its news."""
+        rows = [self._row.get(id(ev)) for ev in news_items]
+        extra = [self._compile(ev) for ev, r in zip(news_items, rows) if r is None]
+        rows = [r for r in rows if r is not None]
+
+        if np is not None:
+            mu = self.mu[rows].sum(axis=0) if rows else np.zeros(len(self.symbols))
+            sigma_mult = self.sigma_mult[rows].prod(axis=0) if rows else np.ones(len(self.symbols))
+            shock = self.shock[rows].sum(axis=0) if rows else np.zeros(len(self.symbols))
+            for e_mu, e_sigma, e_shock in extra:
+                mu, sigma_mult, shock = mu + e_mu, sigma_mult * e_sigma, shock + e_shock
+            return np.asarray(returns) * sigma_mult + mu + shock
+
+        n = len(self.symbols)
+        mu, sigma_mult, shock = [0.0] * n, [1.0] * n, [0.0] * n
+        for e_mu, e_sigma, e_shock in [(self.mu[r], self.sigma_mult[r], self.shock[r]) for r in rows] + extra:
+            mu = [a + b for a, b in zip(mu, e_mu)]
+            sigma_mult = [a * b for a, b in zip(sigma_mult, e_sigma)]
+            shock = [a + b for a, b in zip(shock, e_shock)]
+        return [ret * sm + m + sh for ret, m, sm, sh in zip(returns, mu, sigma_mult, shock)]
+
+
+class OrderBook:
+    """Resting limit and stop orders, held in memory in price-time priority.
+
+    Each symbol has one heap per (side, kind). Entries are keyed so the order
+    that triggers first is on top: a buy limit fills once the price drops to
+    it (highest limit first), a sell limit once it rises to it (lowest
+    first), and stops the other way round. Matching a tick is then a peek
+    per heap plus a pop per triggered order, however many orders rest.
+    Cancelled orders are dropped from `_live` and skipped when they surface.
+    The orders table is the durable copy; load() rebuilds the book from it.
+    """
+
+    # (side, kind) -> +1 if it triggers when price >= its price, -1 if when <=
+    TRIGGER = {("buy", "limit"): -1, ("sell", "limit"): 1, ("buy", "stop"): 1, ("sell", "stop"): -1}
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._heaps = {}
+        self._live = {}
+
+    def load(self, conn: sqlite3.Connection) -> None:
+        rows = conn.execute(
+            "SELECT id, username, symbol, side, kind, qty, price FROM orders WHERE status = 'open' ORDER BY id"
+        ).fetchall()
+        with self._lock:
+            self._heaps, self._live = {}, {}
+        for row in rows:
+            self.add(dict(zip(("id", "username", "symbol", "side", "kind", "qty", "price"), row)))
+
+    def add(self, order: dict) -> None:
+        sign = self.TRIGGER[(order["side"], order["kind"])]
+        with self._lock:
+            self._live[order["id"]] = order
+            heap = self._heaps.setdefault((order["symbol"], order["side"], order["kind"]), [])
+            heapq.heappush(heap, (sign * order["price"], order["id"]))
+
+    def remove(self, order_id: int) -> None:
+        with self._lock:
+            self._live.pop(order_id, None)
+
+    def __len__(self) -> int:
+        return len(self._live)
+
+    def pop_triggered(self, symbol: str, price: float) -> list[dict]:
+        """Take every order on `symbol` that `price` triggers, best priority first."""
+        out = []
+        with self._lock:
+            for (side, kind), sign in self.TRIGGER.items():
+                heap = self._heaps.get((symbol, side, kind))
+                while heap and heap[0][0] <= sign * price:
+                    _, order_id = heapq.heappop(heap)
+                    order = self._live.pop(order_id, None)
+                    if order is not None:
+                        out.append(order)
+        return out
+
+
+def match_orders(conn: sqlite3.Connection, book: OrderBook, symbols: list[str], path: list[list[float]],
+                 first_time: int) -> list[dict]:
+    """Fill resting orders against each tick of `path` (prices per step, aligned to symbols).
+
+    Triggered orders execute at that tick's price, oldest tick first. Cash
+    and shares are checked as fills accumulate; an order the player can no
+    longer cover is rejected instead. Everything is written with a handful
+    of executemany calls in the caller's transaction. Returns the orders
+    that changed state.
+    """
+    triggered = []
+    for k, prices in enumerate(path):
+        for sym, price in zip(symbols, prices):
+            triggered.extend((first_time + k, price, order) for order in book.pop_triggered(sym, price))
+    if not triggered:
+        return []
+
+    # Cancels that committed after the order was popped into this tick.
+    ids = [order["id"] for _, _, order in triggered]
+    still_open = set()
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        still_open.update(r[0] for r in conn.execute(
+            f"SELECT id FROM orders WHERE status = 'open' AND id IN ({','.join('?' * len(chunk))})", chunk))
+    triggered = [t for t in triggered if t[2]["id"] in still_open]
+
+    users = sorted({order["username"] for _, _, order in triggered})
+    marks = ",".join("?" * len(users))
+    balances = dict(conn.execute(f"SELECT username, balance FROM users WHERE username IN ({marks})", users))
+    shares = {(u, s): n for u, s, n in conn.execute(
+        f"SELECT username, symbol, shares FROM holdings WHERE username IN ({marks})", users)}
+
+    results = []
+    for t, price, order in triggered:
+        user, sym, qty = order["username"], order["symbol"], order["qty"]
+        amount = _round_cost(price, qty)
+        status, note = "filled", None
+        if user not in balances:
+            status, note = "rejected", "user not found"
+        elif order["side"] == "buy":
+            if balances[user] < amount:
+                status, note = "rejected", "insufficient funds"
+            else:
+                balances[user] -= amount
+                shares[(user, sym)] = shares.get((user, sym), 0) + qty
+        else:
+            if shares.get((user, sym), 0) < qty:
+                status, note = "rejected", "not enough shares"
+            else:
+                balances[user] += amount
+                shares[(user, sym)] -= qty
+        results.append({**order, "status": status, "note": note, "time": t,
+                        "fill_price": price if status == "filled" else None,
+                        "balance": balances.get(user), "shares": shares.get((user, sym), 0)})
+
+    filled = [r for r in results if r["status"] == "filled"]
+    touched = {r["username"] for r in filled}
+    touched_pairs = {(r["username"], r["symbol"]) for r in filled}
+    conn.executemany(
+        "UPDATE orders SET status = ?, note = ?, fill_price = ?, fill_time = ? WHERE id = ?",
+        [(r["status"], r["note"], r["fill_price"], r["time"], r["id"]) for r in results],
+    )
+    conn.executemany("UPDATE users SET balance = ? WHERE username = ?", [(balances[u], u) for u in touched])
+    conn.executemany(
+        "INSERT OR REPLACE INTO holdings(username, symbol, shares) VALUES(?,?,?)",
+        [(u, s, shares[(u, s)]) for u, s in touched_pairs if shares[(u, s)] > 0],
+    )
+    conn.executemany(
+        "DELETE FROM holdings WHERE username = ? AND symbol = ?",
+        [(u, s) for u, s in touched_pairs if shares[(u, s)] == 0],
+    )
+    for r in filled:
+        sign = -1 if r["side"] == "buy" else 1
+        journal(conn, [(r["username"], "order_" + r["side"], sign * _round_cost(r["fill_price"], r["qty"]),
+                        r["symbol"], -sign * r["qty"], r["fill_price"], f"order:{r['id']}")], r["time"])
+    refresh_net_worth(conn, *touched)
+    return results
+
+
+def advance_market(conn: sqlite3.Connection, first_time: int, turns: list[list[dict]],
+                   effects: NewsEffects | None = None, book: OrderBook | None = None) -> dict:
+    """Advance the market len(turns) ticks, turns[k] being the news at first_time + k.
+
+    The whole path is simulated in memory (one draw for every symbol and
+    every step, then the compiled news effects per step) and written with two
+    executemany calls, so a 40-quarter skip costs about the same as one tick.
+    When `effects` is given, each turn's news shifts the drift, volatility
+    and level of the symbols it mentions. When `book` is given, resting
+    orders are matched against every step's prices. Runs as a TradeWriter
+    op, so the caller owns the transaction. Returns a summary of the move.
+    """
+    rows = conn.execute("SELECT symbol, price FROM stocks ORDER BY symbol").fetchall()
+    steps = len(turns)
+    if not rows or steps == 0:
+        return {"steps": steps, "movers": [], "orders": []}
+    symbols = [r[0] for r in rows]
+    start_prices = [float(r[1]) for r in rows]
+    if effects is not None and effects.symbols != symbols:
+        raise ValueError("news effects were compiled for a different set of stocks")
+
+    n = len(symbols)
+    shocks = draw_returns(steps * n)
+    prices = prev_prices = start_prices
+    history = []
+    path = []
+    for k, news_items in enumerate(turns):
+        returns = shocks[k * n:(k + 1) * n]
+        if effects is not None and news_items:
+            returns = effects.apply(returns, news_items)
+        prev_prices, prices = prices, apply_returns(prices, returns)
+        path.append(prices)
+        t = int(first_time) + k
+        history.extend((sym, t, price) for sym, price in zip(symbols, prices))
+
+    conn.executemany(
+        "UPDATE stocks SET prev_price = ?, price = ? WHERE symbol = ?",
+        zip(prev_prices, prices, symbols),
+    )
+    conn.executemany("INSERT OR REPLACE INTO stock_prices(symbol, time, price) VALUES(?,?,?)", history)
+    history.sort(key=lambda row: row[0])  # stable, so each symbol stays in time order
+    write_candles(conn, history)
+    orders = match_orders(conn, book, symbols, path, first_time) if book is not None else []
+    revalue_net_worth(conn)
+    last_time = int(first_time) + steps - 1
+    if last_time // LEDGER_SNAPSHOT_EVERY != (int(first_time) - 1) // LEDGER_SNAPSHOT_EVERY:
+        snapshot_balances(conn, last_time)
+    save_game_state(conn, last_time)
+
+    moves = sorted(
+        (
+            {"symbol": sym, "from": p0, "to": p1, "change_pct": (p1 - p0) / p0 * 100.0}
+            for sym, p0, p1 in zip(symbols, start_prices, prices)
+        ),
+        key=lambda m: abs(m["change_pct"]),
+        reverse=True,
+    )
+    return {"steps": steps, "movers": moves[:3], "orders": orders}
+
+
+def write_candles(conn: sqlite3.Connection, history) -> None:
+    """Fold (symbol, time, price) rows, in time order per symbol, into stock_candles.
+
+    Rows are first rolled up in memory, so a tick costs one statement per
+    touched candle rather than one per price. A candle whose opening tick is
+    in `history` is written whole (replacing any stale one left by an
+    earlier run); one already under way keeps its open and widens its
+    high/low.
+    """
+    candles = {}
+    for sym, t, price in history:
+        for bucket in CANDLE_BUCKETS:
+            start = t - t % bucket
+            c = candles.get((sym, bucket, start))
+            if c is None:
+                candles[(sym, bucket, start)] = [price, price, price, price, t == start]
+            else:
+                c[1] = max(c[1], price)
+                c[2] = min(c[2], price)
+                c[3] = price
+
+    fresh = [(sym, b, st, o, h, l, c) for (sym, b, st), (o, h, l, c, new) in candles.items() if new]
+    ongoing = [(sym, b, st, o, h, l, c) for (sym, b, st), (o, h, l, c, new) in candles.items() if not new]
+    conn.executemany(
+        "INSERT OR REPLACE INTO stock_candles(symbol, bucket, start, open, high, low, close) VALUES(?,?,?,?,?,?,?)",
+        fresh,
+    )
+    conn.executemany(
+        """
+        INSERT INTO stock_candles(symbol, bucket, start, open, high, low, close) VALUES(?,?,?,?,?,?,?)
+        ON CONFLICT(symbol, bucket, start) DO UPDATE SET
+            high = max(high, excluded.high),
+            low = min(low, excluded.low),
+            close = excluded.close
+        """,
+        ongoing,
+    )
+
+
+NET_WORTH_UPSERT = """
+    INSERT OR REPLACE INTO net_worth(username, cash, holdings_value, net_worth)
+    SELECT u.username, u.balance, COALESCE(v.value, 0), u.balance + COALESCE(v.value, 0)
+    FROM users u
+    LEFT JOIN (
+        SELECT h.username, SUM(h.shares * s.price) AS value
+        FROM holdings h JOIN stocks s ON s.symbol = h.symbol
+        {where}
+        GROUP BY h.username
+    ) v ON v.username = u.username
+    {where_user}
+"""
+
+
+def refresh_net_worth(conn: sqlite3.Connection, *usernames: str) -> None:
+    """Recompute the net_worth rows of the users a trade op just touched."""
+    conn.executemany(
+        NET_WORTH_UPSERT.format(where="WHERE h.username = ?", where_user="WHERE u.username = ?"),
+        [(u, u) for u in usernames],
+    )
+
+
+def journal(conn: sqlite3.Connection, entries: list[tuple], time_value: int | None = None) -> None:
+    """Append (username, kind, cash_delta, symbol, shares_delta, price, ref) rows to the ledger.
+
+    Called by every op that moves cash or shares, inside its transaction,
+    so the journal commits (or rolls back) together with the change.
+    """
+    t = TIME if time_value is None else time_value
+    conn.executemany(
+        "INSERT INTO ledger(time, username, kind, cash_delta, symbol, shares_delta, price, ref) "
+        "VALUES(?,?,?,?,?,?,?,?)",
+        [(t, *entry) for entry in entries],
+    )
+
+
+def snapshot_balances(conn: sqlite3.Connection, time_value: int) -> None:
+    conn.execute(
+        "INSERT OR REPLACE INTO balance_snapshots(username, time, balance, ledger_id) "
+        "SELECT username, ?, balance, (SELECT COALESCE(MAX(id), 0) FROM ledger) FROM users",
+        (time_value,),
+    )
+
+
+def balance_at(conn: sqlite3.Connection, username: str, time_value: int) -> int | None:
+    """A user's balance at the end of tick `time_value`: nearest snapshot plus the ledger since.
+
+    None if that is before the user's first snapshot and the ledger does not
+    account for the balance it recorded: the game was upgraded mid-way and
+    has no journal from before then. Users start at 0, so otherwise
+    replaying from 0 is exact.
+    """
+    snap = conn.execute(
+        "SELECT balance, ledger_id FROM balance_snapshots WHERE username = ? AND time <= ? "
+        "ORDER BY time DESC LIMIT 1",
+        (username, time_value),
+    ).fetchone()
+    if snap is None:
+        first = conn.execute(
+            "SELECT balance, ledger_id FROM balance_snapshots WHERE username = ? ORDER BY time LIMIT 1",
+            (username,),
+        ).fetchone()
+        if first is not None:
+            logged = conn.execute(
+                "SELECT COALESCE(SUM(cash_delta), 0) FROM ledger WHERE username = ? AND id <= ?",
+                (username, first[1]),
+            ).fetchone()[0]
+            if int(logged) != int(first[0]):
+                return None
+    start, after_id = (int(snap[0]), int(snap[1])) if snap else (0, 0)
+    delta = conn.execute(
+        "SELECT COALESCE(SUM(cash_delta), 0) FROM ledger WHERE username = ? AND id > ? AND time <= ?",
+        (username, after_id, time_value),
+    ).fetchone()[0]
+    return start + int(delta)
+
+
+def revalue_net_worth(conn: sqlite3.Connection) -> None:
+    """Mark every holder's net_worth row to the current stocks prices in one statement."""
+    conn.execute(
+        """
+        UPDATE net_worth SET holdings_value = v.value, net_worth = net_worth.cash + v.value
+        FROM (
+            SELECT h.username, SUM(h.shares * s.price) AS value
+            FROM holdings h JOIN stocks s ON s.symbol = h.symbol
+            GROUP BY h.username
+        ) AS v
+        WHERE net_worth.username = v.username
+        """
+    )
 
 
 def _get_stock_price(cur, symbol: str) -> float | None:
@@ -295,609 +1130,2037 @@ def _round_cost(price: float, qty: int) -> int:
     return int(round(price * qty))
 
 
-class Handler(SimpleHTTPRequestHandler):
-    def do_GET(self):
-        u = urlparse(self.path)
+# --- Mutations -------------------------------------------------------------
+# Everything that changes balances or holdings is an "apply_*" op run on the
+# TradeWriter thread. Ops get the writer's connection, already inside the
+# batch transaction, and return (http_status, payload). They must not commit.
 
-        if u.path == "/user":
-            qs = parse_qs(u.query)
-            username = normalise_username((qs.get("username") or [""])[0])
 
-            conn = sqlite3.connect(self.server.users_db_path)
-            try:
-                row = conn.execute(
-                    "SELECT balance FROM users WHERE username = ?",
-                    (username,),
-                ).fetchone()
-            finally:
-                conn.close()
+def apply_register(conn: sqlite3.Connection, username: str) -> tuple[int, dict]:
+    conn.execute("INSERT OR IGNORE INTO users (username, balance) VALUES (?, ?)", (username, 0))
+    refresh_net_worth(conn, username)
+    return 200, {"ok": True, "username": username}
 
-            if not row:
-                self.send_response(404)
-                payload = {"ok": False, "error": "user not found"}
-            else:
-                self.send_response(200)
-                payload = {
-                    "ok": True,
-                    "username": username,
-                    "balance": row[0],
-                    "time": TIME,
-                    "time_string": format_time(TIME),
-                }
-
-            self.send_header("Content-Type", "application/json; charset=utf-8")
-            self.end_headers()
-            self.wfile.write(json.dumps(payload).encode("utf-8"))
-            return
 
-        if u.path == "/users":
-            conn = sqlite3.connect(self.server.users_db_path)
-            try:
-                rows = conn.execute("SELECT username, balance FROM users ORDER BY username").fetchall()
-            finally:
-                conn.close()
+def apply_set_balance(conn: sqlite3.Connection, username: str, balance: int) -> tuple[int, dict]:
+    row = conn.execute("SELECT balance FROM users WHERE username = ?", (username,)).fetchone()
+    conn.execute("UPDATE users SET balance = ? WHERE username = ?", (balance, username))
+    if row:
+        journal(conn, [(username, "set_balance", balance - int(row[0]), None, None, None, None)])
+    refresh_net_worth(conn, username)
+    return 200, {"ok": True, "cmd": "set_balance", "username": username, "balance": balance}
 
-            self.send_response(200)
-            payload = {"ok": True, "users": [{"username": r[0], "balance": r[1]} for r in rows]}
-            self.send_header("Content-Type", "application/json; charset=utf-8")
-            self.end_headers()
-            self.wfile.write(json.dumps(payload).encode("utf-8"))
-            return
 
-        if u.path == "/news":
-            qs = parse_qs(u.query)
+def apply_adjust_balance(conn: sqlite3.Connection, username: str, delta: int) -> tuple[int, dict]:
+    row = conn.execute("SELECT balance FROM users WHERE username = ?", (username,)).fetchone()
+    if not row:
+        return 404, {"ok": False, "error": "user not found"}
+    new_balance = int(row[0]) + int(delta)
+    conn.execute("UPDATE users SET balance = ? WHERE username = ?", (new_balance, username))
+    journal(conn, [(username, "adjust_balance", int(delta), None, None, None, None)])
+    refresh_net_worth(conn, username)
+    return 200, {"ok": True, "cmd": "adjust_balance", "username": username, "balance": new_balance}
+
+
+def apply_transfer(conn: sqlite3.Connection, from_user: str, to_user: str, amount: int) -> tuple[int, dict]:
+    cur = conn.cursor()
+    row_from = cur.execute("SELECT balance FROM users WHERE username = ?", (from_user,)).fetchone()
+    row_to = cur.execute("SELECT balance FROM users WHERE username = ?", (to_user,)).fetchone()
+
+    if not row_from or not row_to:
+        return 404, {"ok": False, "error": "unknown user"}
+    if int(row_from[0]) < amount:
+        return 400, {"ok": False, "error": "insufficient funds"}
+
+    cur.execute("UPDATE users SET balance = balance - ? WHERE username = ?", (amount, from_user))
+    cur.execute("UPDATE users SET balance = balance + ? WHERE username = ?", (amount, to_user))
+    journal(conn, [
+        (from_user, "transfer_out", -amount, None, None, None, to_user),
+        (to_user, "transfer_in", amount, None, None, None, from_user),
+    ])
+    refresh_net_worth(conn, from_user, to_user)
+
+    new_from = cur.execute("SELECT balance FROM users WHERE username = ?", (from_user,)).fetchone()[0]
+    new_to = cur.execute("SELECT balance FROM users WHERE username = ?", (to_user,)).fetchone()[0]
+    return 200, {
+        "ok": True,
+        "from": from_user,
+        "to": to_user,
+        "amount": amount,
+        "from_balance": new_from,
+        "to_balance": new_to,
+    }
+
+
+def apply_buy(conn: sqlite3.Connection, username: str, symbol: str, qty: int) -> tuple[int, dict]:
+    cur = conn.cursor()
+    urow = cur.execute("SELECT balance FROM users WHERE username = ?", (username,)).fetchone()
+    if not urow:
+        return 404, {"ok": False, "error": "user not found"}
+
+    price = _get_stock_price(cur, symbol)
+    if price is None:
+        return 404, {"ok": False, "error": "stock not found"}
+
+    cost = _round_cost(price, qty)
+    bal = int(urow[0])
+    if bal < cost:
+        return 400, {"ok": False, "error": "insufficient funds", "balance": bal, "cost": cost}
+
+    cur.execute("UPDATE users SET balance = balance - ? WHERE username = ?", (cost, username))
+    cur.execute(
+        "INSERT INTO holdings(username, symbol, shares) VALUES(?,?,?) "
+        "ON CONFLICT(username, symbol) DO UPDATE SET shares = shares + excluded.shares",
+        (username, symbol, qty),
+    )
+    journal(conn, [(username, "buy", -cost, symbol, qty, price, None)])
+    refresh_net_worth(conn, username)
+    new_bal = cur.execute("SELECT balance FROM users WHERE username = ?", (username,)).fetchone()[0]
+    new_shares = cur.execute(
+        "SELECT shares FROM holdings WHERE username = ? AND symbol = ?",
+        (username, symbol),
+    ).fetchone()[0]
+    return 200, {
+        "ok": True,
+        "username": username,
+        "symbol": symbol,
+        "qty": qty,
+        "price": price,
+        "cost": cost,
+        "balance": int(new_bal),
+        "shares": int(new_shares),
+        "time": TIME,
+        "time_string": format_time(TIME),
+    }
+
+
+def apply_sell(conn: sqlite3.Connection, username: str, symbol: str, qty: int) -> tuple[int, dict]:
+    cur = conn.cursor()
+    urow = cur.execute("SELECT balance FROM users WHERE username = ?", (username,)).fetchone()
+    if not urow:
+        return 404, {"ok": False, "error": "user not found"}
+
+    price = _get_stock_price(cur, symbol)
+    if price is None:
+        return 404, {"ok": False, "error": "stock not found"}
+
+    hrow = cur.execute(
+        "SELECT shares FROM holdings WHERE username = ? AND symbol = ?",
+        (username, symbol),
+    ).fetchone()
+    if not hrow:
+        return 400, {"ok": False, "error": "no shares to sell"}
+
+    have = int(hrow[0])
+    if have < qty:
+        return 400, {"ok": False, "error": "not enough shares", "shares": have}
+
+    proceeds = _round_cost(price, qty)
+    cur.execute("UPDATE users SET balance = balance + ? WHERE username = ?", (proceeds, username))
+    remaining = have - qty
+    if remaining == 0:
+        cur.execute("DELETE FROM holdings WHERE username = ? AND symbol = ?", (username, symbol))
+    else:
+        cur.execute(
+            "UPDATE holdings SET shares = ? WHERE username = ? AND symbol = ?",
+            (remaining, username, symbol),
+        )
+    journal(conn, [(username, "sell", proceeds, symbol, -qty, price, None)])
+    refresh_net_worth(conn, username)
+    new_bal = cur.execute("SELECT balance FROM users WHERE username = ?", (username,)).fetchone()[0]
+    return 200, {
+        "ok": True,
+        "username": username,
+        "symbol": symbol,
+        "qty": qty,
+        "price": price,
+        "proceeds": proceeds,
+        "balance": int(new_bal),
+        "shares": int(remaining),
+        "time": TIME,
+        "time_string": format_time(TIME),
+    }
+
+
+def apply_order_batch(conn: sqlite3.Connection, username: str, legs: list[tuple]) -> tuple[int, dict]:
+    """Market buys and sells for one user as a single all-or-nothing trade.
+
+    legs are (side, symbol, qty). Every leg is priced from the stocks table
+    inside this one transaction, so they all fill at the same tick. Sells are
+    checked against current holdings and settle first, so their proceeds can
+    pay for the buys; if any leg fails nothing is written.
+    """
+    cur = conn.cursor()
+    urow = cur.execute("SELECT balance FROM users WHERE username = ?", (username,)).fetchone()
+    if not urow:
+        return 404, {"ok": False, "error": "user not found"}
+
+    symbols = sorted({symbol for _, symbol, _ in legs})
+    marks = ",".join("?" * len(symbols))
+    prices = dict(cur.execute(f"SELECT symbol, price FROM stocks WHERE symbol IN ({marks})", symbols))
+    shares = dict(cur.execute(
+        f"SELECT symbol, shares FROM holdings WHERE username = ? AND symbol IN ({marks})",
+        (username, *symbols),
+    ))
+
+    balance = int(urow[0])
+    fills = [None] * len(legs)
+    # Sells first, against what the user holds before the batch.
+    for i, (side, symbol, qty) in sorted(enumerate(legs), key=lambda leg: leg[1][0] != "sell"):
+        price = prices.get(symbol)
+        if price is None:
+            return 404, {"ok": False, "error": "stock not found", "leg": i, "symbol": symbol}
+        amount = _round_cost(float(price), qty)
+        have = shares.get(symbol, 0)
+        if side == "sell":
+            if have < qty:
+                return 400, {"ok": False, "error": "not enough shares", "leg": i, "symbol": symbol, "shares": have}
+            shares[symbol] = have - qty
+            balance += amount
+        else:
+            if balance < amount:
+                return 400, {"ok": False, "error": "insufficient funds", "leg": i, "symbol": symbol,
+                             "balance": balance, "cost": amount}
+            shares[symbol] = have + qty
+            balance -= amount
+        fills[i] = {"side": side, "symbol": symbol, "qty": qty, "price": float(price), "amount": amount}
+
+    ref = f"batch:{secrets.token_hex(4)}"
+    cur.execute("UPDATE users SET balance = ? WHERE username = ?", (balance, username))
+    cur.executemany(
+        "INSERT INTO holdings(username, symbol, shares) VALUES(?,?,?) "
+        "ON CONFLICT(username, symbol) DO UPDATE SET shares = excluded.shares",
+        [(username, sym, n) for sym, n in shares.items() if n > 0],
+    )
+    cur.executemany(
+        "DELETE FROM holdings WHERE username = ? AND symbol = ?",
+        [(username, sym) for sym, n in shares.items() if n == 0],
+    )
+    journal(conn, [
+        (username, f["side"], f["amount"] if f["side"] == "sell" else -f["amount"], f["symbol"],
+         f["qty"] if f["side"] == "buy" else -f["qty"], f["price"], ref)
+        for f in fills
+    ])
+    refresh_net_worth(conn, username)
+    return 200, {
+        "ok": True,
+        "username": username,
+        "batch": ref.split(":", 1)[1],
+        "legs": fills,
+        "cash_delta": balance - int(urow[0]),
+        "balance": balance,
+        "shares": {sym: n for sym, n in sorted(shares.items())},
+        "time": TIME,
+        "time_string": format_time(TIME),
+    }
+
+
+def apply_place_order(conn: sqlite3.Connection, username: str, symbol: str, side: str, kind: str,
+                      qty: int, price: float) -> tuple[int, dict]:
+    if not conn.execute("SELECT 1 FROM users WHERE username = ?", (username,)).fetchone():
+        return 404, {"ok": False, "error": "user not found"}
+    if _get_stock_price(conn, symbol) is None:
+        return 404, {"ok": False, "error": "stock not found"}
+    cur = conn.execute(
+        "INSERT INTO orders(username, symbol, side, kind, qty, price, placed_time) VALUES(?,?,?,?,?,?,?)",
+        (username, symbol, side, kind, qty, price, TIME),
+    )
+    order = {"id": cur.lastrowid, "username": username, "symbol": symbol, "side": side, "kind": kind,
+             "qty": qty, "price": price}
+    return 200, {"ok": True, "order": order, "time": TIME, "time_string": format_time(TIME)}
+
+
+def apply_cancel_order(conn: sqlite3.Connection, username: str, order_id: int) -> tuple[int, dict]:
+    cur = conn.execute(
+        "UPDATE orders SET status = 'cancelled' WHERE id = ? AND username = ? AND status = 'open'",
+        (order_id, username),
+    )
+    if cur.rowcount == 0:
+        return 404, {"ok": False, "error": "no open order with that id"}
+    return 200, {"ok": True, "id": order_id, "status": "cancelled"}
+
+
+def apply_create_market(conn: sqlite3.Connection, title: str, kind: str, outcomes: list) -> tuple[int, dict]:
+    cur = conn.execute(
+        "INSERT INTO bet_markets(title, kind, created_time) VALUES(?,?,?)",
+        (title, kind, TIME),
+    )
+    market_id = cur.lastrowid
+    conn.executemany(
+        "INSERT INTO bet_outcomes(market_id, outcome, odds) VALUES(?,?,?)",
+        [(market_id, name, odds) for name, odds in outcomes],
+    )
+    market = {"id": market_id, "title": title, "kind": kind, "status": "open", "winner": None,
+              "outcomes": {name: {"odds": odds, "pool": 0, "bets": 0} for name, odds in outcomes}}
+    return 200, {"ok": True, "cmd": "create_market", "market": market}
+
+
+def apply_place_bet(conn: sqlite3.Connection, username: str, market_id: int, outcome: str,
+                    stake: int) -> tuple[int, dict]:
+    market = conn.execute("SELECT status FROM bet_markets WHERE id = ?", (market_id,)).fetchone()
+    if not market:
+        return 404, {"ok": False, "error": "market not found"}
+    if market[0] != "open":
+        return 400, {"ok": False, "error": "market is " + market[0]}
+    orow = conn.execute(
+        "SELECT odds FROM bet_outcomes WHERE market_id = ? AND outcome = ?",
+        (market_id, outcome),
+    ).fetchone()
+    if not orow:
+        return 404, {"ok": False, "error": "unknown outcome"}
+    urow = conn.execute("SELECT balance FROM users WHERE username = ?", (username,)).fetchone()
+    if not urow:
+        return 404, {"ok": False, "error": "user not found"}
+    if int(urow[0]) < stake:
+        return 400, {"ok": False, "error": "insufficient funds", "balance": int(urow[0])}
+
+    conn.execute("UPDATE users SET balance = balance - ? WHERE username = ?", (stake, username))
+    cur = conn.execute(
+        "INSERT INTO bets(market_id, username, outcome, stake, odds, placed_time) VALUES(?,?,?,?,?,?)",
+        (market_id, username, outcome, stake, orow[0], TIME),
+    )
+    journal(conn, [(username, "bet", -stake, None, None, None, f"bet:{cur.lastrowid}")])
+    refresh_net_worth(conn, username)
+    return 200, {
+        "ok": True,
+        "bet": {"id": cur.lastrowid, "market_id": market_id, "outcome": outcome, "stake": stake, "odds": orow[0]},
+        "balance": int(urow[0]) - stake,
+    }
+
+
+def apply_request_withdrawal(conn: sqlite3.Connection, username: str, amount: int, delay: int) -> tuple[int, dict]:
+    urow = conn.execute("SELECT balance FROM users WHERE username = ?", (username,)).fetchone()
+    if not urow:
+        return 404, {"ok": False, "error": "user not found"}
+    if int(urow[0]) < amount:
+        return 400, {"ok": False, "error": "insufficient funds", "balance": int(urow[0])}
+
+    conn.execute("UPDATE users SET balance = balance - ? WHERE username = ?", (amount, username))
+    due = TIME + delay
+    cur = conn.execute(
+        "INSERT INTO withdrawals(username, amount, requested_time, due_time) VALUES(?,?,?,?)",
+        (username, amount, TIME, due),
+    )
+    journal(conn, [(username, "withdraw", -amount, None, None, None, f"withdrawal:{cur.lastrowid}")])
+    refresh_net_worth(conn, username)
+    return 200, {
+        "ok": True,
+        "withdrawal": {"id": cur.lastrowid, "amount": amount, "due_time": due, "due_time_string": format_time(due)},
+        "balance": int(urow[0]) - amount,
+    }
+
+
+def apply_cancel_withdrawal(conn: sqlite3.Connection, username: str, withdrawal_id: int) -> tuple[int, dict]:
+    row = conn.execute(
+        "UPDATE withdrawals SET status = 'cancelled' WHERE id = ? AND username = ? AND status = 'pending' "
+        "RETURNING amount",
+        (withdrawal_id, username),
+    ).fetchone()
+    if not row:
+        return 404, {"ok": False, "error": "no pending withdrawal with that id"}
+    conn.execute("UPDATE users SET balance = balance + ? WHERE username = ?", (row[0], username))
+    journal(conn, [(username, "withdraw_cancel", int(row[0]), None, None, None, f"withdrawal:{withdrawal_id}")])
+    refresh_net_worth(conn, username)
+    balance = conn.execute("SELECT balance FROM users WHERE username = ?", (username,)).fetchone()[0]
+    return 200, {"ok": True, "id": withdrawal_id, "status": "cancelled", "refunded": int(row[0]), "balance": int(balance)}
+
+
+def apply_release_withdrawals(conn: sqlite3.Connection, ids: list[int], time_value: int) -> list[tuple]:
+    """Mark the given withdrawals paid out; returns (id, username, amount) for those still pending."""
+    released = []
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        released.extend(conn.execute(
+            f"UPDATE withdrawals SET status = 'released', released_time = ? "
+            f"WHERE status = 'pending' AND id IN ({','.join('?' * len(chunk))}) RETURNING id, username, amount",
+            [time_value, *chunk],
+        ).fetchall())
+    return released
+
+
+def apply_close_market(conn: sqlite3.Connection, market_id: int) -> tuple[int, dict]:
+    cur = conn.execute("UPDATE bet_markets SET status = 'closed' WHERE id = ? AND status = 'open'", (market_id,))
+    if cur.rowcount == 0:
+        return 404, {"ok": False, "error": "no open market with that id"}
+    return 200, {"ok": True, "cmd": "close_market", "id": market_id, "status": "closed"}
+
+
+def apply_settle_market(conn: sqlite3.Connection, market_id: int, winner: str | None) -> tuple[int, dict]:
+    """Pay out a market in one pass over its bets; winner=None voids it and refunds every stake.
+
+    Fixed-odds winners get stake * the odds locked in when they bet.
+    Pari-mutuel winners split the whole pool (less BET_RAKE) in proportion to
+    their stakes; if nobody backed the winner, everyone is refunded.
+    Payouts are rounded down to whole dollars.
+    """
+    market = conn.execute("SELECT kind, status FROM bet_markets WHERE id = ?", (market_id,)).fetchone()
+    if not market:
+        return 404, {"ok": False, "error": "market not found"}
+    kind, status = market
+    if status not in ("open", "closed"):
+        return 400, {"ok": False, "error": "market is already " + status}
+    if winner is not None and not conn.execute(
+        "SELECT 1 FROM bet_outcomes WHERE market_id = ? AND outcome = ?", (market_id, winner)
+    ).fetchone():
+        return 404, {"ok": False, "error": "unknown outcome"}
+
+    total, winning = conn.execute(
+        "SELECT COALESCE(SUM(stake), 0), COALESCE(SUM(CASE WHEN outcome = ? THEN stake END), 0) "
+        "FROM bets WHERE market_id = ?",
+        (winner, market_id),
+    ).fetchone()
+
+    if winner is None or (kind == "parimutuel" and winning == 0):
+        conn.execute("UPDATE bets SET payout = stake WHERE market_id = ?", (market_id,))
+    elif kind == "fixed":
+        conn.execute(
+            "UPDATE bets SET payout = CASE WHEN outcome = ? THEN CAST(stake * odds AS INTEGER) ELSE 0 END "
+            "WHERE market_id = ?",
+            (winner, market_id),
+        )
+    else:
+        factor = total * (1.0 - BET_RAKE) / winning
+        conn.execute(
+            "UPDATE bets SET payout = CASE WHEN outcome = ? THEN CAST(stake * ? AS INTEGER) ELSE 0 END "
+            "WHERE market_id = ?",
+            (winner, factor, market_id),
+        )
 
-            # Backwards compatible:
-            # - If ?time= is provided, return ONLY that quarter (ordered oldest->newest).
-            # - Otherwise, return a feed of the most recent items across all time (newest first).
-            has_time = "time" in qs
+    payouts = """
+        (SELECT username, SUM(payout) AS amount FROM bets
+         WHERE market_id = ? AND payout > 0 GROUP BY username) AS p
+    """
+    conn.execute(
+        f"UPDATE users SET balance = balance + p.amount FROM {payouts} WHERE users.username = p.username",
+        (market_id,),
+    )
+    conn.execute(
+        "INSERT INTO ledger(time, username, kind, cash_delta, ref) "
+        "SELECT ?, username, 'bet_payout', payout, 'bet:' || id FROM bets WHERE market_id = ? AND payout > 0",
+        (TIME, market_id),
+    )
+    conn.execute(
+        f"UPDATE net_worth SET cash = cash + p.amount, net_worth = net_worth + p.amount FROM {payouts} "
+        "WHERE net_worth.username = p.username",
+        (market_id,),
+    )
+    paid = conn.execute(
+        f"SELECT p.username, p.amount, u.balance FROM {payouts} JOIN users u ON u.username = p.username",
+        (market_id,),
+    ).fetchall()
+    conn.execute(
+        "UPDATE bet_markets SET status = ?, winner = ?, settled_time = ? WHERE id = ?",
+        ("void" if winner is None else "settled", winner, TIME, market_id),
+    )
+    return 200, {
+        "ok": True,
+        "cmd": "settle_market",
+        "id": market_id,
+        "status": "void" if winner is None else "settled",
+        "winner": winner,
+        "pool": int(total),
+        "paid_out": int(sum(r[1] for r in paid)),
+        "payouts": {r[0]: {"amount": int(r[1]), "balance": int(r[2])} for r in paid},
+    }
+
+
+class TradeWriter:
+    """Single writer thread for the users database.
+
+    Requests queue an op and block until it has been committed. The writer
+    drains whatever is waiting (up to max_batch ops) and applies it in one
+    BEGIN IMMEDIATE ... COMMIT, so a burst of trades after a tick costs one
+    lock acquisition and one commit instead of one each. Every op runs inside
+    its own savepoint, so an op that raises is undone without failing the
+    rest of the batch.
+    """
 
-            try:
-                limit = int((qs.get("limit") or ["200"])[0])
-            except Exception:
-                limit = 200
-            limit = max(1, min(limit, 2000))
+    def __init__(self, db_path, max_batch: int = WRITER_MAX_BATCH, metrics=None):
+        self.db_path = str(db_path)
+        self.max_batch = max(1, int(max_batch))
+        self.metrics = metrics
+        # Bumped after every commit, so readers can tell whether user data moved.
+        self.generation = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="trade-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, op, *args):
+        """Run op(conn, *args) on the writer thread and return its result."""
+        started = time.perf_counter()
+        fut = Future()
+        self._queue.put((op, args, fut, started))
+        try:
+            return fut.result()
+        finally:
+            charge_request(DB_TIME, time.perf_counter() - started)
 
-            try:
-                offset = int((qs.get("offset") or ["0"])[0])
-            except Exception:
-                offset = 0
-            offset = max(0, offset)
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
 
-            if has_time:
+    def _run(self) -> None:
+        conn = open_db(self.db_path)
+        conn.isolation_level = None  # we issue BEGIN/COMMIT ourselves
+        try:
+            stopping = False
+            while not stopping:
+                item = self._queue.get()
+                if item is None:
+                    break
+                batch = [item]
+                while len(batch) < self.max_batch:
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        stopping = True
+                        break
+                    batch.append(item)
+                self._apply_batch(conn, batch)
+        finally:
+            conn.close()
+
+    def _apply_batch(self, conn: sqlite3.Connection, batch: list) -> None:
+        outcomes = []
+        try:
+            started = time.perf_counter()
+            conn.execute("BEGIN IMMEDIATE")
+            if self.metrics is not None:
+                self.metrics.observe_writer_batch(batch, started, time.perf_counter())
+            for op, args, fut, _ in batch:
+                conn.execute("SAVEPOINT op")
                 try:
-                    time_value = int((qs.get("time") or [str(TIME)])[0])
-                except Exception:
-                    time_value = TIME
-
-            conn = sqlite3.connect(self.server.news_db_path)
-            try:
-                if has_time:
-                    rows = conn.execute(
-                        "SELECT time, headline, body, effects_json FROM news WHERE time = ? ORDER BY id ASC LIMIT ? OFFSET ?",
-                        (time_value, limit, offset),
-                    ).fetchall()
-                else:
-                    rows = conn.execute(
-                        "SELECT time, headline, body, effects_json FROM news ORDER BY id DESC LIMIT ? OFFSET ?",
-                        (limit, offset),
-                    ).fetchall()
-            finally:
-                conn.close()
+                    result = op(conn, *args)
+                except Exception as e:
+                    conn.execute("ROLLBACK TO op")
+                    conn.execute("RELEASE op")
+                    outcomes.append((fut, None, e))
+                    continue
+                conn.execute("RELEASE op")
+                outcomes.append((fut, result, None))
+            conn.execute("COMMIT")
+            self.generation += 1
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            for _, _, fut, _ in batch:
+                fut.set_exception(e)
+            return
 
-            items = []
-            for t, headline, body, effects_json in rows:
-                try:
-                    effects = json.loads(effects_json) if effects_json else {}
-                except Exception:
-                    effects = {}
-                items.append({
-                    "time": int(t),
-                    "time_string": format_time(int(t)),
-                    "headline": headline,
-                    "body": body,
-                    "effects": effects,
-                })
+        for fut, result, error in outcomes:
+            if error is not None:
+                fut.set_exception(error)
+            else:
+                fut.set_result(result)
 
-            self.send_response(200)
-            payload = {
-                "ok": True,
-                "time": TIME if not has_time else time_value,
-                "time_string": format_time(TIME if not has_time else time_value),
-                "limit": limit,
-                "offset": offset,
-                "items": items,
-            }
-            self.send_header("Content-Type", "application/json; charset=utf-8")
-            self.end_headers()
-            self.wfile.write(json.dumps(payload).encode("utf-8"))
-            return
 
-        if u.path == "/stocks":
-            conn = sqlite3.connect(self.server.users_db_path)
-            try:
-                rows = conn.execute(
-                    "SELECT symbol, name, industry, price, prev_price FROM stocks ORDER BY industry, symbol"
-                ).fetchall()
-            finally:
-                conn.close()
+class TimerWheel:
+    """Hashed timer wheel indexed by game tick.
 
-            stocks = []
-            for sym, name, industry, price, prev in rows:
-                stocks.append({
-                    "symbol": sym,
-                    "name": name,
-                    "industry": industry,
-                    "price": float(price),
-                    "prev_price": float(prev),
-                })
+    An entry due at tick t sits in slot t % size, so advancing the clock
+    visits only the slots for the ticks that passed and pops the entries in
+    them that are due; everything else is untouched. Entries more than
+    `size` ticks out share a slot with nearer ones and wait for a later lap.
+    An entry scheduled for a tick that was already swept goes in the next
+    tick's slot, so the next pop_due still returns it.
+    """
 
-            self.send_response(200)
-            payload = {"ok": True, "time": TIME, "time_string": format_time(TIME), "stocks": stocks}
-            self.send_header("Content-Type", "application/json; charset=utf-8")
-            self.end_headers()
-            self.wfile.write(json.dumps(payload).encode("utf-8"))
-            return
+    def __init__(self, size: int = 64):
+        self.size = max(1, int(size))
+        self._lock = threading.Lock()
+        self._slots = [dict() for _ in range(self.size)]
+        # key -> the tick whose slot holds it
+        self._due = {}
+        self._swept = None
+
+    def schedule(self, key, due: int) -> None:
+        with self._lock:
+            self._cancel_locked(key)
+            tick = due if self._swept is None else max(due, self._swept + 1)
+            self._slots[tick % self.size][key] = due
+            self._due[key] = tick
+
+    def cancel(self, key) -> None:
+        with self._lock:
+            self._cancel_locked(key)
+
+    def _cancel_locked(self, key) -> None:
+        due = self._due.pop(key, None)
+        if due is not None:
+            self._slots[due % self.size].pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._due)
+
+    def pop_due(self, first: int, last: int) -> list:
+        """Remove and return every key due at or before `last`, visiting ticks first..last."""
+        out = []
+        with self._lock:
+            span = range(first, last + 1) if last - first + 1 < self.size else range(self.size)
+            for t in span:
+                slot = self._slots[t % self.size]
+                due_now = [key for key, due in slot.items() if due <= last]
+                for key in due_now:
+                    del slot[key]
+                    del self._due[key]
+                out.extend(due_now)
+            self._swept = last if self._swept is None else max(self._swept, last)
+        return out
+
+
+class BettingPools:
+    """Every betting market with running stake totals per outcome, held in memory.
+
+    Bets are added here after they commit, so listing markets and quoting
+    pari-mutuel odds never re-sums the bets table. Settlement still totals
+    the pool in SQL, inside its own transaction.
+    """
 
-        if u.path == "/stock":
-            qs = parse_qs(u.query)
-            symbol = (qs.get("symbol") or [""])[0].strip().upper()
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._markets = {}
+
+    def load(self, conn: sqlite3.Connection) -> None:
+        markets = {}
+        for mid, title, kind, status, winner in conn.execute(
+            "SELECT id, title, kind, status, winner FROM bet_markets ORDER BY id"
+        ):
+            markets[mid] = {"id": mid, "title": title, "kind": kind, "status": status, "winner": winner,
+                            "outcomes": {}}
+        for mid, outcome, odds in conn.execute("SELECT market_id, outcome, odds FROM bet_outcomes"):
+            markets[mid]["outcomes"][outcome] = {"odds": odds, "pool": 0, "bets": 0}
+        for mid, outcome, pool, count in conn.execute(
+            "SELECT market_id, outcome, SUM(stake), COUNT(*) FROM bets GROUP BY market_id, outcome"
+        ):
+            markets[mid]["outcomes"][outcome].update(pool=int(pool), bets=int(count))
+        with self._lock:
+            self._markets = markets
+
+    def add_market(self, market: dict) -> None:
+        with self._lock:
+            self._markets[market["id"]] = market
+
+    def add_bet(self, market_id: int, outcome: str, stake: int) -> None:
+        with self._lock:
+            o = self._markets[market_id]["outcomes"][outcome]
+            o["pool"] += stake
+            o["bets"] += 1
+
+    def set_status(self, market_id: int, status: str, winner: str | None = None) -> None:
+        with self._lock:
+            self._markets[market_id]["status"] = status
+            self._markets[market_id]["winner"] = winner
+
+    def view(self, status: str = "open") -> list[dict]:
+        """Markets with pool totals and current decimal odds for each outcome."""
+        out = []
+        with self._lock:
+            for m in self._markets.values():
+                if status != "all" and m["status"] != status:
+                    continue
+                total = sum(o["pool"] for o in m["outcomes"].values())
+                outcomes = []
+                for name, o in m["outcomes"].items():
+                    odds = o["odds"]
+                    if m["kind"] == "parimutuel":
+                        odds = total * (1.0 - BET_RAKE) / o["pool"] if o["pool"] else None
+                    outcomes.append({"outcome": name, "odds": odds, "pool": o["pool"], "bets": o["bets"]})
+                out.append({"id": m["id"], "title": m["title"], "kind": m["kind"], "status": m["status"],
+                            "winner": m["winner"], "pool": total, "outcomes": outcomes})
+        return out
+
+
+def sse_frame(event: str, data: bytes) -> bytes:
+    return b"event: " + event.encode("ascii") + b"\ndata: " + data + b"\n\n"
+
+
+class Broadcaster:
+    """Fan-out of server-sent events to every open /stream.
+
+    Each event is serialized once, then the same bytes are handed to every
+    matching subscriber. Events published with a username only go to streams
+    opened for that user. A subscriber that is too far behind just misses
+    events; every event carries absolute values, so the next one catches it up.
+    """
 
-            conn = sqlite3.connect(self.server.users_db_path)
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subs = {}
+        self._next_token = 0
+
+    def subscribe(self, username: str, deliver) -> int:
+        with self._lock:
+            self._next_token += 1
+            self._subs[self._next_token] = (username, deliver)
+            return self._next_token
+
+    def unsubscribe(self, token: int) -> None:
+        with self._lock:
+            self._subs.pop(token, None)
+
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return len(self._subs)
+
+    def has_subscriber(self, username: str) -> bool:
+        with self._lock:
+            return any(name == username for name, _ in self._subs.values())
+
+    def publish(self, event: str, data, username: str | None = None) -> None:
+        if not isinstance(data, bytes):
+            data = json.dumps(data).encode("utf-8")
+        frame = sse_frame(event, data)
+        with self._lock:
+            targets = [deliver for name, deliver in self._subs.values() if username is None or name == username]
+        for deliver in targets:
             try:
-                row = conn.execute(
-                    "SELECT symbol, name, industry, price, prev_price FROM stocks WHERE symbol = ?",
-                    (symbol,),
-                ).fetchone()
-            finally:
-                conn.close()
+                deliver(frame)
+            except queue.Full:
+                pass
+
+
+class SingleFlight:
+    """Coalesces identical concurrent GETs into one endpoint call.
+
+    The first request for a key (the leader) runs the endpoint; requests for
+    the same key that arrive while it runs, or up to `ttl` seconds after,
+    get the leader's Response object. Keys carry TIME and, where it matters,
+    the writer generation, so nothing is served across a tick or a commit.
+    """
 
-            if not row:
-                self.send_response(404)
-                payload = {"ok": False, "error": "stock not found"}
+    def __init__(self, ttl: float = COALESCE_TTL, max_keys: int = COALESCE_MAX_KEYS):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._flights = {}  # key -> (Future, finished_at or None)
+        self.leaders = 0
+        self.shared = 0
+
+    def do(self, key, compute):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._flights.get(key)
+            if entry is not None and (entry[1] is None or now - entry[1] <= self.ttl):
+                self.shared += 1
+                fut = entry[0]
+                leader = False
             else:
-                sym, name, industry, price, prev = row
-                payload = {
-                    "ok": True,
-                    "time": TIME,
-                    "time_string": format_time(TIME),
-                    "stock": {
-                        "symbol": sym,
-                        "name": name,
-                        "industry": industry,
-                        "price": float(price),
-                        "prev_price": float(prev),
-                    },
-                }
-                self.send_response(200)
-
-            self.send_header("Content-Type", "application/json; charset=utf-8")
-            self.end_headers()
-            self.wfile.write(json.dumps(payload).encode("utf-8"))
-            return
+                if len(self._flights) >= self.max_keys:
+                    self._expire(now)
+                fut = Future()
+                self._flights[key] = (fut, None)
+                self.leaders += 1
+                leader = True
+
+        if not leader:
+            return fut.result()
+        try:
+            result = compute()
+        except BaseException as e:
+            with self._lock:
+                self._flights.pop(key, None)
+            fut.set_exception(e)
+            raise
+        with self._lock:
+            self._flights[key] = (fut, time.monotonic())
+        fut.set_result(result)
+        return result
+
+    def _expire(self, now: float) -> None:
+        for key, (_, finished) in list(self._flights.items()):
+            if finished is not None and now - finished > self.ttl:
+                del self._flights[key]
+
+
+# Per-request time accounting. run_endpoint() opens an accumulator on the
+# thread running the endpoint; pool checkouts, writer submits and JSON
+# encoding charge their time to it. Outside a request it is a no-op.
+DB_TIME = 0
+SERIALIZE_TIME = 1
+_request_clock = threading.local()
+
+
+def charge_request(kind: int, seconds: float) -> None:
+    acc = getattr(_request_clock, "acc", None)
+    if acc is not None:
+        acc[kind] += seconds
+
+
+def run_endpoint(endpoint, game, req):
+    """Call endpoint(game, req) and return (response, [db_seconds, serialize_seconds])."""
+    acc = _request_clock.acc = [0.0, 0.0]
+    try:
+        return endpoint(game, req), acc
+    finally:
+        _request_clock.acc = None
 
-        if u.path == "/stock_history":
-            qs = parse_qs(u.query)
-            symbol = (qs.get("symbol") or [""])[0].strip().upper()
-            try:
-                limit = int((qs.get("limit") or ["120"])[0])
-            except Exception:
-                limit = 120
-            limit = max(1, min(limit, 2000))
 
-            conn = sqlite3.connect(self.server.users_db_path)
-            try:
-                rows = conn.execute(
-                    "SELECT time, price FROM stock_prices WHERE symbol = ? ORDER BY time DESC LIMIT ?",
-                    (symbol, limit),
-                ).fetchall()
-            finally:
-                conn.close()
+class Histogram:
+    """Cumulative-on-export histogram with fixed bucket bounds. Not locked; Metrics holds the lock."""
 
-            series = []
-            for t, price in reversed(rows):
-                series.append({"time": int(t), "time_string": format_time(int(t)), "price": float(price)})
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
 
-            self.send_response(200)
-            payload = {"ok": True, "symbol": symbol, "time": TIME, "time_string": format_time(TIME), "series": series}
-            self.send_header("Content-Type", "application/json; charset=utf-8")
-            self.end_headers()
-            self.wfile.write(json.dumps(payload).encode("utf-8"))
-            return
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
 
-        if u.path == "/holdings":
-            qs = parse_qs(u.query)
-            username = normalise_username((qs.get("username") or [""])[0])
-            if not username:
-                self.send_response(400)
-                payload = {"ok": False, "error": "missing username"}
-                self.send_header("Content-Type", "application/json; charset=utf-8")
-                self.end_headers()
-                self.wfile.write(json.dumps(payload).encode("utf-8"))
-                return
+    def render(self, name: str, labels: str, out: list) -> None:
+        prefix = labels + "," if labels else ""
+        running = 0
+        for bound, n in zip(self.buckets, self.counts):
+            running += n
+            out.append(f'{name}_bucket{{{prefix}le="{bound}"}} {running}')
+        running += self.counts[-1]
+        out.append(f'{name}_bucket{{{prefix}le="+Inf"}} {running}')
+        suffix = "{" + labels + "}" if labels else ""
+        out.append(f"{name}_sum{suffix} {self.sum:.6f}")
+        out.append(f"{name}_count{suffix} {running}")
 
-            conn = sqlite3.connect(self.server.users_db_path)
-            try:
-                # ensure user exists
-                urow = conn.execute("SELECT balance FROM users WHERE username = ?", (username,)).fetchone()
-                if not urow:
-                    self.send_response(404)
-                    payload = {"ok": False, "error": "user not found"}
-                else:
-                    rows = conn.execute(
-                        """
-                        SELECT h.symbol, h.shares, s.name, s.industry, s.price
-                        FROM holdings h
-                        JOIN stocks s ON s.symbol = h.symbol
-                        WHERE h.username = ?
-                        ORDER BY s.industry, h.symbol
-                        """,
-                        (username,),
-                    ).fetchall()
-                    holdings = []
-                    total_value = 0.0
-                    for sym, shares, name, industry, price in rows:
-                        value = float(price) * int(shares)
-                        total_value += value
-                        holdings.append({
-                            "symbol": sym,
-                            "shares": int(shares),
-                            "name": name,
-                            "industry": industry,
-                            "price": float(price),
-                            "value": value,
-                        })
-                    self.send_response(200)
-                    payload = {
-                        "ok": True,
-                        "username": username,
-                        "balance": int(urow[0]),
-                        "time": TIME,
-                        "time_string": format_time(TIME),
-                        "total_value": total_value,
-                        "holdings": holdings,
-                    }
-            finally:
-                conn.close()
 
-            self.send_header("Content-Type", "application/json; charset=utf-8")
-            self.end_headers()
-            self.wfile.write(json.dumps(payload).encode("utf-8"))
-            return
+class Metrics:
+    """Counters and histograms for /metrics, in Prometheus text format.
 
-        return super().do_GET()
+    Recording is a dict lookup and a bisect under one lock, cheap enough to
+    leave on for a whole game. Routes are the ROUTES paths; everything served
+    from webapp/ is "static" and anything else "unmatched", so label
+    cardinality stays fixed whatever clients send.
+    """
 
-    def do_POST(self):
-        global TIME
-        u = urlparse(self.path)
-
-        if u.path == "/admin":
-            if not is_localhost(self):
-                self.send_response(403)
-                self.send_header("Content-Type", "application/json; charset=utf-8")
-                self.end_headers()
-                self.wfile.write(json.dumps({"ok": False, "error": "forbidden"}).encode("utf-8"))
-                return
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.requests = {}        # (route, method, status) -> count
+        self.latency = {}         # route -> Histogram
+        self.db_seconds = {}      # route -> seconds
+        self.serialize_seconds = {}
+        self.writer_queue_wait = Histogram(LATENCY_BUCKETS)
+        self.writer_lock_wait = Histogram(LATENCY_BUCKETS)
+        self.writer_batches = 0
+        self.writer_ops = 0
+        self.ticks = Histogram(TICK_BUCKETS)
+        self.tick_steps = 0
+
+    def observe_request(self, route: str, method: str, status: int, seconds: float,
+                        acc: list | None = None) -> None:
+        with self._lock:
+            key = (route, method, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            hist = self.latency.get(route)
+            if hist is None:
+                hist = self.latency[route] = Histogram(LATENCY_BUCKETS)
+            hist.observe(seconds)
+            if acc is not None:
+                self.db_seconds[route] = self.db_seconds.get(route, 0.0) + acc[DB_TIME]
+                self.serialize_seconds[route] = self.serialize_seconds.get(route, 0.0) + acc[SERIALIZE_TIME]
+
+    def observe_writer_batch(self, batch: list, begin_started: float, begin_done: float) -> None:
+        """One TradeWriter batch: how long each op queued, and how long BEGIN IMMEDIATE blocked."""
+        with self._lock:
+            for *_, submitted in batch:
+                self.writer_queue_wait.observe(begin_started - submitted)
+            self.writer_lock_wait.observe(begin_done - begin_started)
+            self.writer_batches += 1
+            self.writer_ops += len(batch)
+
+    def observe_tick(self, steps: int, seconds: float) -> None:
+        with self._lock:
+            self.ticks.observe(seconds)
+            self.tick_steps += steps
+
+    def render(self, game) -> bytes:
+        out = []
+
+        def header(name: str, kind: str, text: str) -> None:
+            out.append(f"# HELP {name} {text}")
+            out.append(f"# TYPE {name} {kind}")
+
+        with self._lock:
+            header("mm_http_requests_total", "counter", "HTTP requests by route, method and status.")
+            for (route, method, status), n in sorted(self.requests.items()):
+                out.append(f'mm_http_requests_total{{route="{route}",method="{method}",status="{status}"}} {n}')
+            header("mm_http_request_duration_seconds", "histogram",
+                   "Time from parsed request to response written.")
+            for route, hist in sorted(self.latency.items()):
+                hist.render("mm_http_request_duration_seconds", f'route="{route}"', out)
+            header("mm_http_db_seconds_total", "counter",
+                   "Time requests spent holding or waiting for a database connection or the writer.")
+            for route, v in sorted(self.db_seconds.items()):
+                out.append(f'mm_http_db_seconds_total{{route="{route}"}} {v:.6f}')
+            header("mm_http_serialize_seconds_total", "counter", "Time requests spent encoding JSON.")
+            for route, v in sorted(self.serialize_seconds.items()):
+                out.append(f'mm_http_serialize_seconds_total{{route="{route}"}} {v:.6f}')
+            header("mm_writer_queue_wait_seconds", "histogram",
+                   "Time a write op waited for the writer thread to pick it up.")
+            self.writer_queue_wait.render("mm_writer_queue_wait_seconds", "", out)
+            header("mm_writer_lock_wait_seconds", "histogram", "Time BEGIN IMMEDIATE blocked on the write lock.")
+            self.writer_lock_wait.render("mm_writer_lock_wait_seconds", "", out)
+            header("mm_writer_batches_total", "counter", "Writer transactions committed or rolled back.")
+            out.append(f"mm_writer_batches_total {self.writer_batches}")
+            header("mm_writer_ops_total", "counter", "Write ops applied by the writer.")
+            out.append(f"mm_writer_ops_total {self.writer_ops}")
+            header("mm_tick_duration_seconds", "histogram", "Wall time of one inc_time, however many steps.")
+            self.ticks.render("mm_tick_duration_seconds", "", out)
+            header("mm_tick_steps_total", "counter", "Game turns advanced.")
+            out.append(f"mm_tick_steps_total {self.tick_steps}")
+
+        header("mm_singleflight_requests_total", "counter",
+               "Coalesced GETs that ran the endpoint (leader) or reused a result (shared).")
+        out.append(f'mm_singleflight_requests_total{{result="leader"}} {game.flights.leaders}')
+        out.append(f'mm_singleflight_requests_total{{result="shared"}} {game.flights.shared}')
+        header("mm_wait_tick_parked", "gauge", "Requests parked on /wait_tick.")
+        out.append(f"mm_wait_tick_parked {game.tick_parked}")
+        header("mm_game_time", "gauge", "Current game tick.")
+        out.append(f"mm_game_time {TIME}")
+        header("mm_stream_subscribers", "gauge", "Open /stream connections.")
+        out.append(f"mm_stream_subscribers {game.broadcaster.subscriber_count()}")
+        header("mm_process_start_time_seconds", "gauge", "Unix time the server started.")
+        out.append(f"mm_process_start_time_seconds {self.started:.3f}")
+        return ("\n".join(out) + "\n").encode("utf-8")
+
+
+class MarketSnapshot:
+    """The stocks table as of one tick, already serialized for /stocks and /stock.
+
+    Prices only move when advance_market runs, so the server builds one of
+    these per tick and every poll in between just writes the cached bytes.
+    The tick number (plus a per-process token, since a replaced data
+    directory can reuse tick numbers) is the ETag.
+    """
 
-            data = read_json_body(self)
-            cmd = (data.get("cmd") or "").strip()
+    def __init__(self, time_value: int, rows: list[tuple]):
+        self.time = int(time_value)
+        self.etag = f'"{BOOT_ID}-{self.time}"'
+
+        self.stocks = []
+        for sym, name, industry, price, prev in rows:
+            self.stocks.append({
+                "symbol": sym,
+                "name": name,
+                "industry": industry,
+                "price": float(price),
+                "prev_price": float(prev),
+            })
+        self.by_symbol = {st["symbol"]: st for st in self.stocks}
+
+        time_string = format_time(self.time)
+        self.stocks_body = json.dumps(
+            {"ok": True, "time": self.time, "time_string": time_string, "stocks": self.stocks}
+        ).encode("utf-8")
+        self.stocks_gzip = gzip.compress(self.stocks_body, RESPONSE_GZIP_LEVEL, mtime=0)
+        self.stock_bodies = {
+            st["symbol"]: json.dumps(
+                {"ok": True, "time": self.time, "time_string": time_string, "stock": st}
+            ).encode("utf-8")
+            for st in self.stocks
+        }
+
+
+def load_market_snapshot(conn: sqlite3.Connection, time_value: int) -> MarketSnapshot:
+    rows = conn.execute(
+        "SELECT symbol, name, industry, price, prev_price FROM stocks ORDER BY industry, symbol"
+    ).fetchall()
+    return MarketSnapshot(time_value, rows)
+
+
+class Request:
+    """An HTTP request as the endpoints see it, whichever front-end parsed it."""
+
+    def __init__(self, method: str, target: str, headers, body: bytes = b"", client_ip: str = ""):
+        u = urlparse(target)
+        self.method = method
+        self.path = u.path
+        self.query = parse_qs(u.query)
+        self.headers = headers
+        self.body = body
+        if TRUST_FORWARDED and client_ip in ("127.0.0.1", "::1"):
+            client_ip = (headers.get("X-Forwarded-For") or client_ip).split(",")[-1].strip()
+        self.client_ip = client_ip
+
+    def arg(self, name: str, default: str = "") -> str:
+        return (self.query.get(name) or [default])[0]
+
+    def json(self) -> dict:
+        try:
+            return json.loads((self.body or b"{}").decode("utf-8"))
+        except Exception:
+            return {}
 
-            users_conn = sqlite3.connect(self.server.users_db_path)
-            try:
-                users_cur = users_conn.cursor()
+    def form(self) -> dict:
+        return _parse_qs(self.body.decode("utf-8", errors="replace"))
 
-                if cmd == "set_balance":
-                    username = normalise_username(str(data.get("username", "")))
-                    try:
-                        balance = int(data.get("balance", 0))
-                    except Exception:
-                        balance = 0
+    def is_localhost(self) -> bool:
+        return self.client_ip == "127.0.0.1" or self.client_ip == "::1"
 
-                    users_cur.execute("UPDATE users SET balance = ? WHERE username = ?", (balance, username))
-                    users_conn.commit()
 
-                    self.send_response(200)
-                    payload = {"ok": True, "cmd": cmd, "username": username, "balance": balance}
+class Response:
+    """Status, body and headers; encode_response() turns it into bytes on the wire.
 
-                elif cmd == "adjust_balance":
-                    username = normalise_username(str(data.get("username", "")))
-                    try:
-                        delta = int(data.get("delta", 0))
-                    except Exception:
-                        delta = 0
-
-                    row = users_cur.execute("SELECT balance FROM users WHERE username = ?", (username,)).fetchone()
-                    if not row:
-                        self.send_response(404)
-                        payload = {"ok": False, "error": "user not found"}
-                    else:
-                        new_balance = int(row[0]) + int(delta)
-                        users_cur.execute("UPDATE users SET balance = ? WHERE username = ?", (new_balance, username))
-                        users_conn.commit()
-                        self.send_response(200)
-                        payload = {"ok": True, "cmd": cmd, "username": username, "balance": new_balance}
-
-                elif cmd == "inc_time":
-                    step = int(data.get("step", 1))
-                    if step < 1:
-                        step = 1
-
-                    for _ in range(step):
-                        TIME += 1
-                        new_items = generate_news_for_turn(self.server.news_events_bank)
-                        insert_news_items(self.server.news_db_path, TIME, new_items)
-                        tick_stock_market(self.server.users_db_path, new_items, TIME)
-
-                    self.send_response(200)
-                    payload = {"ok": True, "cmd": cmd, "time": TIME, "time_string": format_time(TIME)}
-
-                else:
-                    self.send_response(400)
-                    payload = {"ok": False, "error": "unknown cmd"}
+    gzip_body is an optional pre-compressed copy of body (e.g. a per-tick
+    snapshot compressed once), used instead of compressing per request.
+    """
 
-            finally:
-                users_conn.close()
+    def __init__(self, status: int, body: bytes = b"", content_type: str | None = "application/json; charset=utf-8",
+                 headers: dict | None = None, gzip_body: bytes | None = None):
+        self.status = status
+        self.body = body
+        self.content_type = content_type
+        self.headers = headers or {}
+        self.gzip_body = gzip_body
 
-            self.send_header("Content-Type", "application/json; charset=utf-8")
-            self.end_headers()
-            self.wfile.write(json.dumps(payload).encode("utf-8"))
-            return
 
-        if u.path == "/transfer":
-            data = read_json_body(self)
+class StreamResponse:
+    """Tells the front-end to turn this request into a /stream subscription."""
 
-            from_user = normalise_username(str(data.get("from", "")))
-            to_user = normalise_username(str(data.get("to", "")))
-            try:
-                amount = int(data.get("amount", 0))
-            except Exception:
-                amount = 0
-
-            if not from_user or not to_user:
-                self.send_response(400)
-                payload = {"ok": False, "error": "missing user"}
-            elif from_user == to_user:
-                self.send_response(400)
-                payload = {"ok": False, "error": "cannot send to yourself"}
-            elif amount <= 0:
-                self.send_response(400)
-                payload = {"ok": False, "error": "amount must be positive"}
-            else:
-                conn = sqlite3.connect(self.server.users_db_path)
-                try:
-                    cur = conn.cursor()
-                    cur.execute("BEGIN IMMEDIATE")
-
-                    row_from = cur.execute("SELECT balance FROM users WHERE username = ?", (from_user,)).fetchone()
-                    row_to = cur.execute("SELECT balance FROM users WHERE username = ?", (to_user,)).fetchone()
-
-                    if not row_from or not row_to:
-                        conn.rollback()
-                        self.send_response(404)
-                        payload = {"ok": False, "error": "unknown user"}
-                    elif int(row_from[0]) < amount:
-                        conn.rollback()
-                        self.send_response(400)
-                        payload = {"ok": False, "error": "insufficient funds"}
-                    else:
-                        cur.execute("UPDATE users SET balance = balance - ? WHERE username = ?", (amount, from_user))
-                        cur.execute("UPDATE users SET balance = balance + ? WHERE username = ?", (amount, to_user))
-
-                        new_from = cur.execute("SELECT balance FROM users WHERE username = ?", (from_user,)).fetchone()[0]
-                        new_to = cur.execute("SELECT balance FROM users WHERE username = ?", (to_user,)).fetchone()[0]
-                        conn.commit()
-
-                        self.send_response(200)
-                        payload = {
-                            "ok": True,
-                            "from": from_user,
-                            "to": to_user,
-                            "amount": amount,
-                            "from_balance": new_from,
-                            "to_balance": new_to,
-                        }
-                finally:
-                    conn.close()
-
-            self.send_header("Content-Type", "application/json; charset=utf-8")
-            self.end_headers()
-            self.wfile.write(json.dumps(payload).encode("utf-8"))
-            return
+    def __init__(self, username: str):
+        self.username = username
 
-        if u.path == "/buy":
-            data = read_json_body(self)
-            username = normalise_username(str(data.get("username", "")))
-            symbol = str(data.get("symbol", "")).strip().upper()
-            try:
-                qty = int(data.get("qty", 0))
-            except Exception:
-                qty = 0
-
-            if not username or not symbol:
-                self.send_response(400)
-                payload = {"ok": False, "error": "missing username or symbol"}
-            elif qty <= 0:
-                self.send_response(400)
-                payload = {"ok": False, "error": "qty must be positive"}
-            else:
-                conn = sqlite3.connect(self.server.users_db_path)
-                try:
-                    cur = conn.cursor()
-                    cur.execute("BEGIN IMMEDIATE")
 
-                    urow = cur.execute("SELECT balance FROM users WHERE username = ?", (username,)).fetchone()
-                    if not urow:
-                        conn.rollback()
-                        self.send_response(404)
-                        payload = {"ok": False, "error": "user not found"}
-                    else:
-                        price = _get_stock_price(cur, symbol)
-                        if price is None:
-                            conn.rollback()
-                            self.send_response(404)
-                            payload = {"ok": False, "error": "stock not found"}
-                        else:
-                            cost = _round_cost(price, qty)
-                            bal = int(urow[0])
-                            if bal < cost:
-                                conn.rollback()
-                                self.send_response(400)
-                                payload = {"ok": False, "error": "insufficient funds", "balance": bal, "cost": cost}
-                            else:
-                                cur.execute("UPDATE users SET balance = balance - ? WHERE username = ?", (cost, username))
-                                cur.execute(
-                                    "INSERT INTO holdings(username, symbol, shares) VALUES(?,?,?) "
-                                    "ON CONFLICT(username, symbol) DO UPDATE SET shares = shares + excluded.shares",
-                                    (username, symbol, qty),
-                                )
-                                new_bal = cur.execute("SELECT balance FROM users WHERE username = ?", (username,)).fetchone()[0]
-                                new_shares = cur.execute(
-                                    "SELECT shares FROM holdings WHERE username = ? AND symbol = ?",
-                                    (username, symbol),
-                                ).fetchone()[0]
-                                conn.commit()
-                                self.send_response(200)
-                                payload = {
-                                    "ok": True,
-                                    "username": username,
-                                    "symbol": symbol,
-                                    "qty": qty,
-                                    "price": price,
-                                    "cost": cost,
-                                    "balance": int(new_bal),
-                                    "shares": int(new_shares),
-                                    "time": TIME,
-                                    "time_string": format_time(TIME),
-                                }
-                finally:
-                    conn.close()
-
-            self.send_header("Content-Type", "application/json; charset=utf-8")
-            self.end_headers()
-            self.wfile.write(json.dumps(payload).encode("utf-8"))
-            return
+class TickWait:
+    """Tells the front-end to park this /wait_tick request until the clock passes `since`."""
 
-        if u.path == "/sell":
-            data = read_json_body(self)
-            username = normalise_username(str(data.get("username", "")))
-            symbol = str(data.get("symbol", "")).strip().upper()
-            try:
-                qty = int(data.get("qty", 0))
-            except Exception:
-                qty = 0
-
-            if not username or not symbol:
-                self.send_response(400)
-                payload = {"ok": False, "error": "missing username or symbol"}
-            elif qty <= 0:
-                self.send_response(400)
-                payload = {"ok": False, "error": "qty must be positive"}
+    def __init__(self, since: int, username: str, timeout: float):
+        self.since = since
+        self.username = username
+        self.timeout = timeout
+
+
+def json_response(status: int, payload: dict) -> Response:
+    started = time.perf_counter()
+    body = json.dumps(payload).encode("utf-8")
+    charge_request(SERIALIZE_TIME, time.perf_counter() - started)
+    return Response(status, body)
+
+
+def snapshot_response(req: Request, body: bytes, etag: str, gzip_body: bytes | None = None) -> Response:
+    """Pre-serialized JSON, or 304 if the client already has this version."""
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    sent = req.headers.get("If-None-Match")
+    if sent in (etag, gzip_etag(etag)):
+        headers["ETag"] = sent
+        return Response(304, b"", None, headers)
+    return Response(200, body, headers=headers, gzip_body=gzip_body)
+
+
+def gzip_etag(etag: str) -> str:
+    """The ETag of the gzip-encoded variant, which must differ from the identity one."""
+    return etag[:-1] + '-gz"' if etag.endswith('"') else etag + "-gz"
+
+
+def encode_response(resp: Response, req: Request, keep_alive: bool) -> bytes:
+    """Serialize a response for the wire: the one place headers are written.
+
+    Negotiates gzip for compressible bodies of RESPONSE_GZIP_MIN bytes or
+    more (reusing resp.gzip_body when the endpoint pre-encoded one), sets
+    Content-Length and Connection, and drops the body for HEAD.
+    """
+    body = resp.body
+    headers = resp.headers
+    # Static files arrive already negotiated (Vary / Content-Encoding set).
+    if (resp.status == 200 and "Vary" not in headers and "Content-Encoding" not in headers and resp.content_type
+            and len(body) >= RESPONSE_GZIP_MIN
+            and resp.content_type.split(";")[0] in STATIC_COMPRESSIBLE):
+        headers = dict(headers)
+        headers["Vary"] = "Accept-Encoding"
+        if accepts_gzip(req.headers.get("Accept-Encoding") or ""):
+            if resp.gzip_body is None:
+                # Kept on the response, so a coalesced response is compressed once.
+                resp.gzip_body = gzip.compress(body, RESPONSE_GZIP_LEVEL, mtime=0)
+            body = resp.gzip_body
+            headers["Content-Encoding"] = "gzip"
+            if "ETag" in headers:
+                headers["ETag"] = gzip_etag(headers["ETag"])
+
+    lines = [f"HTTP/1.1 {resp.status} {HTTPStatus(resp.status).phrase}"]
+    if resp.content_type:
+        lines.append(f"Content-Type: {resp.content_type}")
+    for name, value in headers.items():
+        lines.append(f"{name}: {value}")
+    if resp.status != 304:
+        lines.append(f"Content-Length: {len(body)}")
+    lines.append("Connection: keep-alive" if keep_alive else "Connection: close")
+    head = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+    return head if req.method == "HEAD" else head + body
+
+
+def redirect_response(location: str) -> Response:
+    body = (
+        b'<!doctype html><meta charset="utf-8"><a href="'
+        + location.encode("utf-8")
+        + b'">Redirecting...</a>'
+    )
+    return Response(303, body, "text/html; charset=utf-8", {"Location": location})
+
+
+def stream_preamble(game) -> bytes:
+    """First bytes of every /stream: reconnect delay plus the current market."""
+    return b"retry: 3000\n\n" + sse_frame("tick", game.market.stocks_body)
+
+
+class StaticAsset:
+    def __init__(self, path: Path, body: bytes):
+        stat = path.stat()
+        self.mtime = (stat.st_mtime_ns, stat.st_size)
+        self.content_type = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+        if self.content_type.startswith("text/") or self.content_type == "application/javascript":
+            self.content_type += "; charset=utf-8"
+        self.body = body
+        self.etag = '"' + hashlib.sha256(body).hexdigest()[:20] + '"'
+        self.gzip_body = None
+        self.gzip_etag = None
+        if self.content_type.split(";")[0] in STATIC_COMPRESSIBLE and len(body) >= STATIC_GZIP_MIN:
+            packed = gzip.compress(body, 9, mtime=0)
+            if len(packed) < len(body) * 0.9:
+                self.gzip_body = packed
+                self.gzip_etag = self.etag[:-1] + '-gz"'
+        if self.content_type.startswith("text/html"):
+            self.cache_control = "no-cache"
+        else:
+            self.cache_control = f"public, max-age={STATIC_MAX_AGE}"
+
+
+class StaticAssets:
+    """The webapp directory held in memory, with gzip variants built at load.
+
+    Pages are revalidated on every load (ETag + If-None-Match), scripts,
+    styles and images are cached for STATIC_MAX_AGE. With dev=True every
+    lookup checks the file's mtime so edits show up without a restart.
+    """
+
+    def __init__(self, webroot: Path, dev: bool = False):
+        self.webroot = Path(webroot).resolve()
+        self.dev = dev
+        self.lock = threading.Lock()
+        self.assets = {}
+        for path in sorted(self.webroot.rglob("*")):
+            if path.is_file():
+                self.assets[path.relative_to(self.webroot).as_posix()] = StaticAsset(path, path.read_bytes())
+
+    def lookup(self, key: str) -> StaticAsset | None:
+        asset = self.assets.get(key)
+        if not self.dev:
+            return asset
+        path = (self.webroot / key).resolve()
+        if not path.is_relative_to(self.webroot) or not path.is_file():
+            with self.lock:
+                self.assets.pop(key, None)
+            return None
+        stat = path.stat()
+        if asset is None or asset.mtime != (stat.st_mtime_ns, stat.st_size):
+            asset = StaticAsset(path, path.read_bytes())
+            with self.lock:
+                self.assets[key] = asset
+        return asset
+
+    def response(self, req: Request) -> Response:
+        key = unquote(req.path).lstrip("/")
+        if key == "" or key.endswith("/"):
+            key += "index.html"
+        asset = self.lookup(key) or self.lookup(key + "/index.html")
+        if asset is None:
+            return Response(404, b"Not found", "text/plain; charset=utf-8")
+
+        headers = {"Cache-Control": "no-cache" if self.dev else asset.cache_control}
+        body, etag = asset.body, asset.etag
+        if asset.gzip_body is not None:
+            headers["Vary"] = "Accept-Encoding"
+            if accepts_gzip(req.headers.get("Accept-Encoding") or ""):
+                body, etag = asset.gzip_body, asset.gzip_etag
+                headers["Content-Encoding"] = "gzip"
+        headers["ETag"] = etag
+
+        sent = req.headers.get("If-None-Match") or ""
+        if sent.strip() == "*" or any(tag.strip() in (asset.etag, asset.gzip_etag) for tag in sent.split(",")):
+            return Response(304, b"", None, headers)
+        return Response(200, body, asset.content_type, headers)
+
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    for part in accept_encoding.split(","):
+        coding, _, params = part.strip().partition(";")
+        if coding.strip().lower() in ("gzip", "*"):
+            return params.replace(" ", "").lower() not in ("q=0", "q=0.0", "q=0.00", "q=0.000")
+    return False
+
+
+# --- Endpoints -------------------------------------------------------------
+# Each takes (game, request) and returns a Response. @route registers it in
+# ROUTES, which both front-ends dispatch through; anything not in it is a
+# static file under webapp/.
+
+ROUTES = {}
+# Polled (method, path) endpoints that would otherwise flood the console.
+QUIET_PATHS = set()
+
+
+def route(method: str, path: str, quiet: bool = False, coalesce: str | None = None):
+    """Register an endpoint for (method, path). quiet=True keeps it out of the request log.
+
+    coalesce="tick" shares one response between identical requests within a
+    tick, for endpoints that only read data written by inc_time;
+    coalesce="writes" additionally starts afresh after every committed write,
+    for endpoints that read balances or holdings.
+    """
+    def register(endpoint):
+        if (method, path) in ROUTES:
+            raise ValueError(f"duplicate route {method} {path}")
+        ROUTES[(method, path)] = coalesced(endpoint, coalesce == "writes") if coalesce else endpoint
+        if quiet:
+            QUIET_PATHS.add((method, path))
+        return endpoint
+    return register
+
+
+def coalesced(endpoint, per_write: bool):
+    def run(game, req: Request) -> Response:
+        query = tuple(sorted((k, tuple(v)) for k, v in req.query.items()))
+        # TIME moves before refresh_market swaps the snapshot in; keying on both
+        # keeps the old snapshot's responses out of the new tick's entry.
+        key = (req.path, query, req.headers.get("If-None-Match"), TIME, game.market.etag,
+               game.writer.generation if per_write else None)
+        return game.flights.do(key, lambda: endpoint(game, req))
+    return run
+
+
+@route("GET", "/user", quiet=True, coalesce="writes")
+def api_user(game, req: Request) -> Response:
+    username = normalise_username(req.arg("username"))
+
+    with game.users_pool.connection() as conn:
+        row = conn.execute(
+            "SELECT balance FROM users WHERE username = ?",
+            (username,),
+        ).fetchone()
+
+    if not row:
+        return json_response(404, {"ok": False, "error": "user not found"})
+    return json_response(200, {
+        "ok": True,
+        "username": username,
+        "balance": row[0],
+        "time": TIME,
+        "time_string": format_time(TIME),
+    })
+
+
+@route("GET", "/stream", quiet=True)
+def api_stream(game, req: Request) -> StreamResponse:
+    return StreamResponse(normalise_username(req.arg("username")))
+
+
+@route("GET", "/users", quiet=True, coalesce="writes")
+def api_users(game, req: Request) -> Response:
+    with game.users_pool.connection() as conn:
+        rows = conn.execute("SELECT username, balance FROM users ORDER BY username").fetchall()
+
+    return json_response(200, {"ok": True, "users": [{"username": r[0], "balance": r[1]} for r in rows]})
+
+
+@route("GET", "/leaderboard", quiet=True, coalesce="writes")
+def api_leaderboard(game, req: Request) -> Response:
+    try:
+        limit = int(req.arg("limit", "20"))
+    except Exception:
+        limit = 20
+    limit = max(1, min(limit, 500))
+    username = normalise_username(req.arg("username"))
+
+    with game.users_pool.connection() as conn:
+        rows = conn.execute(
+            "SELECT username, cash, holdings_value, net_worth FROM net_worth ORDER BY net_worth DESC, username LIMIT ?",
+            (limit,),
+        ).fetchall()
+        me = None
+        if username:
+            row = conn.execute(
+                "SELECT username, cash, holdings_value, net_worth FROM net_worth WHERE username = ?",
+                (username,),
+            ).fetchone()
+            if row:
+                ahead = conn.execute(
+                    "SELECT COUNT(*) FROM net_worth WHERE net_worth > ? OR (net_worth = ? AND username < ?)",
+                    (row[3], row[3], row[0]),
+                ).fetchone()[0]
+                me = (ahead + 1, row)
+
+    def entry(rank, row):
+        return {"rank": rank, "username": row[0], "cash": int(row[1]),
+                "holdings_value": float(row[2]), "net_worth": float(row[3])}
+
+    payload = {
+        "ok": True,
+        "time": TIME,
+        "time_string": format_time(TIME),
+        "leaders": [entry(rank, row) for rank, row in enumerate(rows, start=1)],
+    }
+    if me is not None:
+        payload["you"] = entry(*me)
+    return json_response(200, payload)
+
+
+@route("GET", "/news", quiet=True, coalesce="tick")
+def api_news(game, req: Request) -> Response:
+    # Backwards compatible:
+    # - If ?time= is provided, return ONLY that quarter (ordered oldest->newest).
+    # - Otherwise, return a feed of the most recent items across all time (newest first).
+    #   Page it with ?before_id=<next_before_id of the previous page>; ?offset=
+    #   still works but gets slower the deeper it goes.
+    has_time = "time" in req.query
+
+    try:
+        limit = int(req.arg("limit", "200"))
+    except Exception:
+        limit = 200
+    limit = max(1, min(limit, 2000))
+
+    try:
+        offset = int(req.arg("offset", "0"))
+    except Exception:
+        offset = 0
+    offset = max(0, offset)
+
+    try:
+        before_id = int(req.arg("before_id")) if req.arg("before_id") else None
+    except Exception:
+        before_id = None
+
+    if has_time:
+        try:
+            time_value = int(req.arg("time", str(TIME)))
+        except Exception:
+            time_value = TIME
+
+    with game.news_pool.connection() as conn:
+        if has_time:
+            rows = conn.execute(
+                "SELECT time, headline, body, effects_json FROM news WHERE time = ? ORDER BY id ASC LIMIT ? OFFSET ?",
+                (time_value, limit, offset),
+            ).fetchall()
+        elif before_id is not None:
+            rows = conn.execute(
+                "SELECT id, time, headline, body, effects_json FROM news WHERE id < ? ORDER BY id DESC LIMIT ?",
+                (before_id, limit),
+            ).fetchall()
+        else:
+            rows = conn.execute(
+                "SELECT id, time, headline, body, effects_json FROM news ORDER BY id DESC LIMIT ? OFFSET ?",
+                (limit, offset),
+            ).fetchall()
+
+    next_before_id = None
+    if not has_time:
+        if len(rows) == limit:
+            next_before_id = int(rows[-1][0])
+        rows = [row[1:] for row in rows]
+    items = [news_row_to_item(row) for row in rows]
+
+    return json_response(200, {
+        "ok": True,
+        "time": TIME if not has_time else time_value,
+        "time_string": format_time(TIME if not has_time else time_value),
+        "limit": limit,
+        "offset": offset,
+        "next_before_id": next_before_id,
+        "items": items,
+    })
+
+
+@route("GET", "/dashboard", quiet=True, coalesce="writes")
+def api_dashboard(game, req: Request) -> Response:
+    username = normalise_username(req.arg("username"))
+    raw_fields = req.arg("fields", ",".join(DASHBOARD_FIELDS))
+    fields = {f.strip() for f in raw_fields.split(",") if f.strip() in DASHBOARD_FIELDS}
+    try:
+        news_limit = int(req.arg("news_limit", "3"))
+    except Exception:
+        news_limit = 3
+    news_limit = max(1, min(news_limit, 50))
+
+    if not username and fields & {"user", "holdings"}:
+        return json_response(400, {"ok": False, "error": "missing username"})
+    return json_response(*game.dashboard(username, fields, news_limit))
+
+
+@route("GET", "/stocks", quiet=True)
+def api_stocks(game, req: Request) -> Response:
+    market = game.market
+    return snapshot_response(req, market.stocks_body, market.etag, market.stocks_gzip)
+
+
+@route("GET", "/stock", quiet=True)
+def api_stock(game, req: Request) -> Response:
+    symbol = req.arg("symbol").strip().upper()
+
+    market = game.market
+    body = market.stock_bodies.get(symbol)
+    if body is None:
+        return json_response(404, {"ok": False, "error": "stock not found"})
+    return snapshot_response(req, body, market.etag)
+
+
+@route("GET", "/stock_history", quiet=True, coalesce="tick")
+def api_stock_history(game, req: Request) -> Response:
+    symbol = req.arg("symbol").strip().upper()
+    try:
+        limit = int(req.arg("limit", "120"))
+    except Exception:
+        limit = 120
+    limit = max(1, min(limit, 2000))
+
+    with game.users_pool.connection() as conn:
+        rows = conn.execute(
+            "SELECT time, price FROM stock_prices WHERE symbol = ? ORDER BY time DESC LIMIT ?",
+            (symbol, limit),
+        ).fetchall()
+
+    series = []
+    for t, price in reversed(rows):
+        series.append({"time": int(t), "time_string": format_time(int(t)), "price": float(price)})
+
+    return json_response(200, {"ok": True, "symbol": symbol, "time": TIME, "time_string": format_time(TIME), "series": series})
+
+
+@route("GET", "/stock_candles", quiet=True, coalesce="tick")
+def api_stock_candles(game, req: Request) -> Response:
+    symbol = req.arg("symbol").strip().upper()
+    try:
+        bucket = int(req.arg("bucket", str(CANDLE_BUCKETS[0])))
+    except Exception:
+        bucket = 0
+    if bucket not in CANDLE_BUCKETS:
+        return json_response(400, {"ok": False, "error": "bucket must be one of " + ", ".join(map(str, CANDLE_BUCKETS))})
+    try:
+        limit = int(req.arg("limit", "60"))
+    except Exception:
+        limit = 60
+    limit = max(1, min(limit, 500))
+
+    # Candles only move on a tick, so the market ETag covers them too.
+    market = game.market
+    etag = f'{market.etag[:-1]}-c{bucket}-{limit}"'
+    if req.headers.get("If-None-Match") in (etag, gzip_etag(etag)):
+        return snapshot_response(req, b"", etag)
+
+    with game.users_pool.connection() as conn:
+        rows = conn.execute(
+            """
+            SELECT start, open, high, low, close FROM stock_candles
+            WHERE symbol = ? AND bucket = ? AND start <= ?
+            ORDER BY start DESC LIMIT ?
+            """,
+            (symbol, bucket, market.time, limit),
+        ).fetchall()
+
+    candles = []
+    for start, o, h, l, c in reversed(rows):
+        candles.append({
+            "start": int(start),
+            "time_string": format_time(int(start)),
+            "open": float(o),
+            "high": float(h),
+            "low": float(l),
+            "close": float(c),
+        })
+
+    payload = {"ok": True, "symbol": symbol, "bucket": bucket, "time": market.time,
+               "time_string": format_time(market.time), "candles": candles}
+    return snapshot_response(req, json.dumps(payload).encode("utf-8"), etag)
+
+
+@route("GET", "/holdings", quiet=True, coalesce="writes")
+def api_holdings(game, req: Request) -> Response:
+    username = normalise_username(req.arg("username"))
+    if not username:
+        return json_response(400, {"ok": False, "error": "missing username"})
+
+    with game.users_pool.connection() as conn:
+        # ensure user exists
+        urow = conn.execute("SELECT balance FROM users WHERE username = ?", (username,)).fetchone()
+        if not urow:
+            return json_response(404, {"ok": False, "error": "user not found"})
+        rows = conn.execute(
+            """
+            SELECT h.symbol, h.shares, s.name, s.industry, s.price
+            FROM holdings h
+            JOIN stocks s ON s.symbol = h.symbol
+            WHERE h.username = ?
+            ORDER BY s.industry, h.symbol
+            """,
+            (username,),
+        ).fetchall()
+
+    holdings = []
+    total_value = 0.0
+    for sym, shares, name, industry, price in rows:
+        value = float(price) * int(shares)
+        total_value += value
+        holdings.append({
+            "symbol": sym,
+            "shares": int(shares),
+            "name": name,
+            "industry": industry,
+            "price": float(price),
+            "value": value,
+        })
+    return json_response(200, {
+        "ok": True,
+        "username": username,
+        "balance": int(urow[0]),
+        "time": TIME,
+        "time_string": format_time(TIME),
+        "total_value": total_value,
+        "holdings": holdings,
+    })
+
+
+@route("GET", "/wait_tick", quiet=True)
+def api_wait_tick(game, req: Request):
+    # Long-poll for clients that can't keep /stream open: answers as soon as
+    # the clock is past ?since=, or with changed=false after ?timeout= seconds.
+    try:
+        since = int(req.arg("since"))
+    except ValueError:
+        return json_response(400, {"ok": False, "error": "since must be an integer tick"})
+    try:
+        timeout = float(req.arg("timeout", str(WAIT_TICK_TIMEOUT)))
+    except ValueError:
+        timeout = WAIT_TICK_TIMEOUT
+    timeout = max(0.0, min(timeout, WAIT_TICK_MAX))
+    username = normalise_username(req.arg("username"))
+
+    change = game.tick_change(since, username)
+    if change is not None or timeout == 0:
+        return json_response(200, change or game.tick_unchanged(since))
+    return TickWait(since, username, timeout)
+
+
+@route("POST", "/admin")
+def api_admin(game, req: Request) -> Response:
+    if not req.is_localhost():
+        return json_response(403, {"ok": False, "error": "forbidden"})
+
+    data = req.json()
+    cmd = (data.get("cmd") or "").strip()
+    writer = game.writer
+
+    if cmd == "set_balance":
+        username = normalise_username(str(data.get("username", "")))
+        try:
+            balance = int(data.get("balance", 0))
+        except Exception:
+            balance = 0
+
+        status, payload = writer.submit(apply_set_balance, username, balance)
+        game.publish_user(username, balance=balance)
+
+    elif cmd == "adjust_balance":
+        username = normalise_username(str(data.get("username", "")))
+        try:
+            delta = int(data.get("delta", 0))
+        except Exception:
+            delta = 0
+
+        status, payload = writer.submit(apply_adjust_balance, username, delta)
+        if status == 200:
+            game.publish_user(username, balance=payload["balance"])
+
+    elif cmd == "inc_time":
+        step = int(data.get("step", 1))
+        if step < 1:
+            step = 1
+
+        summary = game.advance_time(step)
+
+        status = 200
+        payload = {"ok": True, "cmd": cmd, "time": TIME, "time_string": format_time(TIME), **summary}
+
+    elif cmd == "create_market":
+        title = str(data.get("title", "")).strip()
+        kind = str(data.get("kind", "parimutuel")).strip().lower()
+        raw = data.get("outcomes") or []
+        try:
+            if isinstance(raw, dict):
+                outcomes = [(str(name).strip(), float(odds)) for name, odds in raw.items()]
             else:
-                conn = sqlite3.connect(self.server.users_db_path)
-                try:
-                    cur = conn.cursor()
-                    cur.execute("BEGIN IMMEDIATE")
+                outcomes = [(str(name).strip(), None) for name in raw]
+        except Exception:
+            outcomes = []
+
+        if not title or kind not in ("parimutuel", "fixed"):
+            status, payload = 400, {"ok": False, "error": "need a title and kind parimutuel or fixed"}
+        elif len(outcomes) < 2 or len({name for name, _ in outcomes}) != len(outcomes) or not all(n for n, _ in outcomes):
+            status, payload = 400, {"ok": False, "error": "need at least two distinct outcomes"}
+        elif kind == "fixed" and not all(odds is not None and odds > 1.0 for _, odds in outcomes):
+            status, payload = 400, {"ok": False, "error": "fixed-odds outcomes need decimal odds above 1"}
+        else:
+            if kind == "parimutuel":
+                outcomes = [(name, None) for name, _ in outcomes]
+            status, payload = writer.submit(apply_create_market, title, kind, outcomes)
+            if status == 200:
+                game.pools.add_market(payload["market"])
+
+    elif cmd in ("close_market", "settle_market", "void_market"):
+        try:
+            market_id = int(data.get("market_id", 0))
+        except Exception:
+            market_id = 0
+
+        if cmd == "close_market":
+            status, payload = writer.submit(apply_close_market, market_id)
+        elif cmd == "void_market":
+            status, payload = writer.submit(apply_settle_market, market_id, None)
+        else:
+            winner = str(data.get("winner", "")).strip()
+            if not winner:
+                return json_response(400, {"ok": False, "error": "missing winner"})
+            status, payload = writer.submit(apply_settle_market, market_id, winner)
+        if status == 200:
+            game.pools.set_status(market_id, payload["status"], payload.get("winner"))
+            for username, paid in payload.get("payouts", {}).items():
+                game.publish_user(username, balance=paid["balance"])
+
+    else:
+        status = 400
+        payload = {"ok": False, "error": "unknown cmd"}
+
+    return json_response(status, payload)
+
+
+@route("POST", "/transfer")
+def api_transfer(game, req: Request) -> Response:
+    data = req.json()
+
+    from_user = normalise_username(str(data.get("from", "")))
+    to_user = normalise_username(str(data.get("to", "")))
+    try:
+        amount = int(data.get("amount", 0))
+    except Exception:
+        amount = 0
+
+    if not from_user or not to_user:
+        return json_response(400, {"ok": False, "error": "missing user"})
+    if from_user == to_user:
+        return json_response(400, {"ok": False, "error": "cannot send to yourself"})
+    if amount <= 0:
+        return json_response(400, {"ok": False, "error": "amount must be positive"})
+
+    status, payload = game.writer.submit(apply_transfer, from_user, to_user, amount)
+    if status == 200:
+        game.publish_user(from_user, balance=payload["from_balance"])
+        game.publish_user(to_user, balance=payload["to_balance"])
+    return json_response(status, payload)
+
+
+def _trade(game, req: Request, op) -> Response:
+    data = req.json()
+    username = normalise_username(str(data.get("username", "")))
+    symbol = str(data.get("symbol", "")).strip().upper()
+    try:
+        qty = int(data.get("qty", 0))
+    except Exception:
+        qty = 0
+
+    if not username or not symbol:
+        return json_response(400, {"ok": False, "error": "missing username or symbol"})
+    if qty <= 0:
+        return json_response(400, {"ok": False, "error": "qty must be positive"})
+
+    status, payload = game.writer.submit(op, username, symbol, qty)
+    if status == 200:
+        game.publish_user(username, balance=payload["balance"], holdings={symbol: payload["shares"]})
+    return json_response(status, payload)
+
+
+@route("POST", "/buy")
+def api_buy(game, req: Request) -> Response:
+    return _trade(game, req, apply_buy)
+
+
+@route("POST", "/sell")
+def api_sell(game, req: Request) -> Response:
+    return _trade(game, req, apply_sell)
+
+
+@route("POST", "/orders")
+def api_order_batch(game, req: Request) -> Response:
+    # {"username": ..., "legs": [{"side": "sell", "symbol": "GME", "qty": 5}, {"side": "buy", ...}]}
+    data = req.json()
+    username = normalise_username(str(data.get("username", "")))
+    raw = data.get("legs")
+    if not username:
+        return json_response(400, {"ok": False, "error": "missing username"})
+    if not isinstance(raw, list) or not raw:
+        return json_response(400, {"ok": False, "error": "legs must be a non-empty list"})
+    if len(raw) > ORDER_BATCH_MAX:
+        return json_response(400, {"ok": False, "error": f"at most {ORDER_BATCH_MAX} legs per batch"})
+
+    legs = []
+    for i, leg in enumerate(raw):
+        if not isinstance(leg, dict):
+            return json_response(400, {"ok": False, "error": "each leg must be an object", "leg": i})
+        side = str(leg.get("side", "")).strip().lower()
+        symbol = str(leg.get("symbol", "")).strip().upper()
+        try:
+            qty = int(leg.get("qty", 0))
+        except Exception:
+            qty = 0
+        if side not in ("buy", "sell"):
+            return json_response(400, {"ok": False, "error": "side must be buy or sell", "leg": i})
+        if not symbol:
+            return json_response(400, {"ok": False, "error": "missing symbol", "leg": i})
+        if qty <= 0:
+            return json_response(400, {"ok": False, "error": "qty must be positive", "leg": i})
+        legs.append((side, symbol, qty))
+
+    status, payload = game.writer.submit(apply_order_batch, username, legs)
+    if status == 200:
+        game.publish_user(username, balance=payload["balance"], holdings=payload["shares"])
+    return json_response(status, payload)
+
+
+@route("POST", "/order")
+def api_order(game, req: Request) -> Response:
+    data = req.json()
+    username = normalise_username(str(data.get("username", "")))
+    symbol = str(data.get("symbol", "")).strip().upper()
+    side = str(data.get("side", "")).strip().lower()
+    kind = str(data.get("type", "limit")).strip().lower()
+    try:
+        qty = int(data.get("qty", 0))
+        price = float(data.get("price", 0))
+    except Exception:
+        qty, price = 0, 0.0
+
+    if not username or not symbol:
+        return json_response(400, {"ok": False, "error": "missing username or symbol"})
+    if (side, kind) not in OrderBook.TRIGGER:
+        return json_response(400, {"ok": False, "error": "side must be buy or sell, type limit or stop"})
+    if qty <= 0:
+        return json_response(400, {"ok": False, "error": "qty must be positive"})
+    if not price > 0 or price == float("inf"):
+        return json_response(400, {"ok": False, "error": "price must be positive"})
+
+    status, payload = game.writer.submit(apply_place_order, username, symbol, side, kind, qty, price)
+    if status == 200:
+        game.book.add(payload["order"])
+    return json_response(status, payload)
+
+
+@route("POST", "/cancel_order")
+def api_cancel_order(game, req: Request) -> Response:
+    data = req.json()
+    username = normalise_username(str(data.get("username", "")))
+    try:
+        order_id = int(data.get("id", 0))
+    except Exception:
+        order_id = 0
+    if not username or order_id <= 0:
+        return json_response(400, {"ok": False, "error": "missing username or id"})
+
+    status, payload = game.writer.submit(apply_cancel_order, username, order_id)
+    if status == 200:
+        game.book.remove(order_id)
+    return json_response(status, payload)
+
+
+@route("GET", "/orders", quiet=True)
+def api_orders(game, req: Request) -> Response:
+    username = normalise_username(req.arg("username"))
+    if not username:
+        return json_response(400, {"ok": False, "error": "missing username"})
+    status = req.arg("status", "open")
+    try:
+        limit = int(req.arg("limit", "100"))
+    except Exception:
+        limit = 100
+    limit = max(1, min(limit, 1000))
 
-                    urow = cur.execute("SELECT balance FROM users WHERE username = ?", (username,)).fetchone()
-                    if not urow:
-                        conn.rollback()
-                        self.send_response(404)
-                        payload = {"ok": False, "error": "user not found"}
-                    else:
-                        price = _get_stock_price(cur, symbol)
-                        if price is None:
-                            conn.rollback()
-                            self.send_response(404)
-                            payload = {"ok": False, "error": "stock not found"}
-                        else:
-                            hrow = cur.execute(
-                                "SELECT shares FROM holdings WHERE username = ? AND symbol = ?",
-                                (username, symbol),
-                            ).fetchone()
-                            if not hrow:
-                                conn.rollback()
-                                self.send_response(400)
-                                payload = {"ok": False, "error": "no shares to sell"}
-                            else:
-                                have = int(hrow[0])
-                                if have < qty:
-                                    conn.rollback()
-                                    self.send_response(400)
-                                    payload = {"ok": False, "error": "not enough shares", "shares": have}
-                                else:
-                                    proceeds = _round_cost(price, qty)
-                                    cur.execute("UPDATE users SET balance = balance + ? WHERE username = ?", (proceeds, username))
-                                    remaining = have - qty
-                                    if remaining == 0:
-                                        cur.execute("DELETE FROM holdings WHERE username = ? AND symbol = ?", (username, symbol))
-                                    else:
-                                        cur.execute(
-                                            "UPDATE holdings SET shares = ? WHERE username = ? AND symbol = ?",
-                                            (remaining, username, symbol),
-                                        )
-                                    new_bal = cur.execute("SELECT balance FROM users WHERE username = ?", (username,)).fetchone()[0]
-                                    conn.commit()
-                                    self.send_response(200)
-                                    payload = {
-                                        "ok": True,
-                                        "username": username,
-                                        "symbol": symbol,
-                                        "qty": qty,
-                                        "price": price,
-                                        "proceeds": proceeds,
-                                        "balance": int(new_bal),
-                                        "shares": int(remaining),
-                                        "time": TIME,
-                                        "time_string": format_time(TIME),
-                                    }
-                finally:
-                    conn.close()
-
-            self.send_header("Content-Type", "application/json; charset=utf-8")
-            self.end_headers()
-            self.wfile.write(json.dumps(payload).encode("utf-8"))
-            return
+    columns = ("id", "symbol", "side", "kind", "qty", "price", "placed_time", "status", "note", "fill_price", "fill_time")
+    sql = f"SELECT {', '.join(columns)} FROM orders WHERE username = ?"
+    params = [username]
+    if status != "all":
+        sql += " AND status = ?"
+        params.append(status)
+    sql += " ORDER BY id DESC LIMIT ?"
+    params.append(limit)
+
+    with game.users_pool.connection() as conn:
+        rows = conn.execute(sql, params).fetchall()
+
+    return json_response(200, {"ok": True, "username": username, "time": TIME, "time_string": format_time(TIME),
+                               "orders": [dict(zip(columns, row)) for row in rows]})
+
+
+@route("GET", "/bet_markets", quiet=True)
+def api_bet_markets(game, req: Request) -> Response:
+    status = req.arg("status", "open")
+    return json_response(200, {"ok": True, "time": TIME, "time_string": format_time(TIME),
+                               "markets": game.pools.view(status)})
+
+
+@route("POST", "/bet")
+def api_bet(game, req: Request) -> Response:
+    data = req.json()
+    username = normalise_username(str(data.get("username", "")))
+    outcome = str(data.get("outcome", "")).strip()
+    try:
+        market_id = int(data.get("market_id", 0))
+        stake = int(data.get("stake", 0))
+    except Exception:
+        market_id, stake = 0, 0
+
+    if not username or not outcome or market_id <= 0:
+        return json_response(400, {"ok": False, "error": "missing username, market_id or outcome"})
+    if stake <= 0:
+        return json_response(400, {"ok": False, "error": "stake must be positive"})
 
-        # login/register form at /
-        if u.path in ("/login", "/register"):
+    status, payload = game.writer.submit(apply_place_bet, username, market_id, outcome, stake)
+    if status == 200:
+        game.pools.add_bet(market_id, outcome, stake)
+        game.publish_user(username, balance=payload["balance"])
+    return json_response(status, payload)
+
+
+@route("GET", "/bets", quiet=True)
+def api_bets(game, req: Request) -> Response:
+    username = normalise_username(req.arg("username"))
+    if not username:
+        return json_response(400, {"ok": False, "error": "missing username"})
+    try:
+        limit = int(req.arg("limit", "100"))
+    except Exception:
+        limit = 100
+    limit = max(1, min(limit, 1000))
+
+    with game.users_pool.connection() as conn:
+        rows = conn.execute(
+            """
+            SELECT b.id, b.market_id, m.title, m.status, b.outcome, b.stake, b.odds, b.payout
+            FROM bets b JOIN bet_markets m ON m.id = b.market_id
+            WHERE b.username = ?
+            ORDER BY b.id DESC LIMIT ?
+            """,
+            (username, limit),
+        ).fetchall()
+
+    columns = ("id", "market_id", "title", "market_status", "outcome", "stake", "odds", "payout")
+    return json_response(200, {"ok": True, "username": username, "bets": [dict(zip(columns, r)) for r in rows]})
+
+
+@route("POST", "/withdraw")
+def api_withdraw(game, req: Request) -> Response:
+    data = req.json()
+    username = normalise_username(str(data.get("username", "")))
+    try:
+        amount = int(data.get("amount", 0))
+    except Exception:
+        amount = 0
+
+    if not username:
+        return json_response(400, {"ok": False, "error": "missing username"})
+    if amount <= 0:
+        return json_response(400, {"ok": False, "error": "amount must be positive"})
+
+    status, payload = game.writer.submit(apply_request_withdrawal, username, amount, CASHOUT_DELAY)
+    if status == 200:
+        game.cashouts.schedule(payload["withdrawal"]["id"], payload["withdrawal"]["due_time"])
+        game.publish_user(username, balance=payload["balance"])
+    return json_response(status, payload)
+
+
+@route("POST", "/cancel_withdrawal")
+def api_cancel_withdrawal(game, req: Request) -> Response:
+    data = req.json()
+    username = normalise_username(str(data.get("username", "")))
+    try:
+        withdrawal_id = int(data.get("id", 0))
+    except Exception:
+        withdrawal_id = 0
+    if not username or withdrawal_id <= 0:
+        return json_response(400, {"ok": False, "error": "missing username or id"})
+
+    status, payload = game.writer.submit(apply_cancel_withdrawal, username, withdrawal_id)
+    if status == 200:
+        game.cashouts.cancel(withdrawal_id)
+        game.publish_user(username, balance=payload["balance"])
+    return json_response(status, payload)
+
+
+@route("GET", "/withdrawals", quiet=True)
+def api_withdrawals(game, req: Request) -> Response:
+    username = normalise_username(req.arg("username"))
+    if not username:
+        return json_response(400, {"ok": False, "error": "missing username"})
+    status = req.arg("status", "all")
+
+    sql = "SELECT id, amount, requested_time, due_time, status, released_time FROM withdrawals WHERE username = ?"
+    params = [username]
+    if status != "all":
+        sql += " AND status = ?"
+        params.append(status)
+    sql += " ORDER BY id DESC LIMIT 100"
+
+    with game.users_pool.connection() as conn:
+        rows = conn.execute(sql, params).fetchall()
+
+    items = []
+    for wid, amount, requested, due, wstatus, released in rows:
+        items.append({"id": wid, "amount": int(amount), "requested_time": requested, "due_time": due,
+                      "due_time_string": format_time(due), "status": wstatus, "released_time": released})
+    return json_response(200, {"ok": True, "username": username, "time": TIME, "time_string": format_time(TIME),
+                               "withdrawals": items})
+
+
+@route("GET", "/ledger", quiet=True)
+def api_ledger(game, req: Request) -> Response:
+    """A user's journal from tick ?since= on, oldest first.
+
+    Page with ?after_id=<next_after_id of the previous page>. ?at=<tick> adds
+    the balance as of the end of that tick, rebuilt from the nearest snapshot.
+    """
+    username = normalise_username(req.arg("username"))
+    if not username:
+        return json_response(400, {"ok": False, "error": "missing username"})
+    try:
+        since = int(req.arg("since", "0"))
+        after_id = int(req.arg("after_id", "0"))
+        limit = int(req.arg("limit", "100"))
+        at = int(req.arg("at")) if req.arg("at") else None
+    except Exception:
+        return json_response(400, {"ok": False, "error": "since, after_id, limit and at must be integers"})
+    limit = max(1, min(limit, 1000))
+
+    columns = ("id", "time", "kind", "cash_delta", "symbol", "shares_delta", "price", "ref")
+    with game.users_pool.connection() as conn:
+        rows = conn.execute(
+            f"SELECT {', '.join(columns)} FROM ledger WHERE username = ? AND id > ? AND time >= ? ORDER BY id LIMIT ?",
+            (username, after_id, since, limit),
+        ).fetchall()
+        balance = balance_at(conn, username, at) if at is not None else None
+
+    payload = {
+        "ok": True,
+        "username": username,
+        "time": TIME,
+        "time_string": format_time(TIME),
+        "entries": [dict(zip(columns, row)) for row in rows],
+        "next_after_id": rows[-1][0] if len(rows) == limit else None,
+    }
+    if at is not None:
+        # balance is null when the ledger does not reach back to `at`.
+        payload["balance_at"] = {"time": at, "time_string": format_time(at), "balance": balance,
+                                 "known": balance is not None}
+    return json_response(200, payload)
+
+
+@route("GET", "/metrics", quiet=True)
+def api_metrics(game, req: Request) -> Response:
+    if not req.is_localhost():
+        return json_response(403, {"ok": False, "error": "forbidden"})
+    return Response(200, game.metrics.render(game), "text/plain; version=0.0.4; charset=utf-8")
+
+
+@route("POST", "/login")
+@route("POST", "/register")
+def api_register(game, req: Request) -> Response:
+    # login/register form at /
+    form = req.form()
+    raw_username = (form.get("username") or [""])[0]
+    username = normalise_username(raw_username)
+
+    if not username:
+        return redirect_response("/")
+
+    game.writer.submit(apply_register, username)
+    return redirect_response(f"/dashboard.html?username={quote(username)}")
+
+
+def find_route(req: Request):
+    """The endpoint for a request, or None for static files. HEAD runs the GET endpoint."""
+    return ROUTES.get(("GET" if req.method == "HEAD" else req.method, req.path))
+
+
+def metrics_route(req: Request) -> str:
+    """The /metrics route label for a request."""
+    if find_route(req) is not None:
+        return req.path
+    if req.method in ("GET", "HEAD"):
+        return "static"
+    return "unmatched"
+
+
+class Handler(BaseHTTPRequestHandler):
+    def dispatch(self, method: str) -> None:
+        body = b""
+        if method == "POST":
             length = int(self.headers.get("Content-Length", "0"))
-            body = self.rfile.read(length).decode("utf-8", errors="replace")
-            form = _parse_qs(body)
-
-            raw_username = (form.get("username") or [""])[0]
-            username = normalise_username(raw_username)
-
-            if not username:
-                self.send_response(303)
-                self.send_header("Location", "/")
-                self.send_header("Content-Type", "text/html; charset=utf-8")
-                self.end_headers()
-                self.wfile.write(b'<!doctype html><meta charset="utf-8"><a href="/">Redirecting...</a>')
+            body = self.rfile.read(length) if length > 0 else b""
+        req = Request(method, self.path, self.headers, body, self.client_address[0])
+        game = self.server.game
+        started = time.perf_counter()
+        route, status, acc = metrics_route(req), 500, None
+        try:
+            endpoint = find_route(req)
+            if endpoint is not None:
+                resp, acc = run_endpoint(endpoint, game, req)
+            elif method in ("GET", "HEAD"):
+                resp = self.server.assets.response(req)
+            else:
+                resp = Response(404, b"", None)
+
+            if isinstance(resp, StreamResponse):
+                game.metrics.observe_request(route, method, 200, time.perf_counter() - started, acc)
+                route = None
+                self.serve_stream(resp.username)
                 return
+            if isinstance(resp, TickWait):
+                resp = json_response(200, game.wait_tick(resp))
+
+            status = resp.status
+            self.log_request(status)
+            self.close_connection = True
+            self.wfile.write(encode_response(resp, req, keep_alive=False))
+        finally:
+            if route is not None:
+                game.metrics.observe_request(route, method, status, time.perf_counter() - started, acc)
+
+    def serve_stream(self, username: str) -> None:
+        """Hold the connection open and relay broadcaster events as SSE frames."""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
 
-            conn = sqlite3.connect(self.server.users_db_path)
-            try:
-                conn.execute(
-                    "INSERT OR IGNORE INTO users (username, balance) VALUES (?, ?)",
-                    (username, 0)
-                )
-                conn.commit()
-            finally:
-                conn.close()
-
-            self.send_response(303)
-            self.send_header("Location", f"/dashboard.html?username={quote(username)}")
-            self.send_header("Content-Type", "text/html; charset=utf-8")
-            self.end_headers()
-            self.wfile.write(
-                b'<!doctype html><meta charset="utf-8"><a href="/dashboard.html?username='
-                + quote(username).encode("utf-8")
-                + b'">Redirecting...</a>'
-            )
-            return
+        game = self.server.game
+        inbox = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+        token = game.broadcaster.subscribe(username, inbox.put_nowait)
+        try:
+            self.wfile.write(stream_preamble(game))
+            self.wfile.flush()
+            while True:
+                try:
+                    frame = inbox.get(timeout=STREAM_KEEPALIVE)
+                except queue.Empty:
+                    frame = b": keepalive\n\n"
+                self.wfile.write(frame)
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError, TimeoutError):
+            pass
+        finally:
+            game.broadcaster.unsubscribe(token)
 
-        self.send_response(404)
-        self.end_headers()
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_HEAD(self):
+        self.dispatch("HEAD")
+
+    def do_POST(self):
+        self.dispatch("POST")
 
     def log_message(self, format, *args):
         try:
@@ -905,24 +3168,490 @@ class Handler(SimpleHTTPRequestHandler):
         except Exception:
             path = self.path
 
-        if path in ("/user", "/users", "/news", "/stocks", "/stock", "/stock_history", "/holdings"):
+        method = getattr(self, "command", None)
+        method = "GET" if method == "HEAD" else method
+        if (method, path) in QUIET_PATHS:
             return
         super().log_message(format, *args)
 
 
-def main() -> None:
-    global TIME
+class Game:
+    """One game's live state: connection pools, writer thread, market snapshot and stream fan-out.
+
+    Front-ends (the threaded GameServer or the asyncio AsyncServer) hold one
+    of these and pass it to every endpoint.
+    """
+
+    def __init__(self, users_db_path, news_db_path, events_bank, pool_size: int = DB_POOL_SIZE):
+        self.users_db_path = str(users_db_path)
+        self.news_db_path = str(news_db_path)
+        self.news_events_bank = events_bank
+        self.users_pool = ConnectionPool(self.users_db_path, pool_size)
+        self.news_pool = ConnectionPool(self.news_db_path, pool_size)
+        self.metrics = Metrics()
+        self.writer = TradeWriter(self.users_db_path, metrics=self.metrics)
+        with self.users_pool.connection() as conn:
+            symbols = [r[0] for r in conn.execute("SELECT symbol FROM stocks ORDER BY symbol")]
+        self.news_effects = NewsEffects(events_bank, symbols)
+        self.book = OrderBook()
+        self.pools = BettingPools()
+        self.cashouts = TimerWheel()
+        with self.users_pool.connection() as conn:
+            self.book.load(conn)
+            self.pools.load(conn)
+            pending = conn.execute("SELECT id, due_time FROM withdrawals WHERE status = 'pending'").fetchall()
+        # Cash-outs that fell due on the tick before a crash, but weren't
+        # released yet, go out now; the rest wait on the wheel.
+        overdue = [wid for wid, due in pending if due <= TIME]
+        for wid, due in pending:
+            if due > TIME:
+                self.cashouts.schedule(wid, due)
+        if overdue:
+            self.writer.submit(apply_release_withdrawals, overdue, TIME)
+        self.broadcaster = Broadcaster()
+        self.flights = SingleFlight()
+        # /wait_tick: threaded waiters sleep on tick_cond, asyncio ones register a listener.
+        self.tick_cond = threading.Condition()
+        self.tick_listeners = set()
+        self.tick_parked = 0
+        self.last_tick = None
+        self.clock_lock = threading.Lock()
+        self.market = None
+        self.refresh_market()
+
+    def refresh_market(self) -> None:
+        """Rebuild the cached market snapshot and push it to /stream clients.
+
+        Call after every committed tick.
+        """
+        with self.users_pool.connection() as conn:
+            self.market = load_market_snapshot(conn, TIME)
+        self.broadcaster.publish("tick", self.market.stocks_body)
+
+    def advance_time(self, steps: int) -> dict:
+        """Move the game clock forward `steps` turns and return a summary.
+
+        All turns are generated up front and persisted with one transaction
+        per database, whatever the step count, so skipping a few years
+        between sessions doesn't hold the write lock for long.
+        """
+        global TIME
+        with self.clock_lock:
+            started = time.perf_counter()
+            first = TIME + 1
+            turns = [generate_news_for_turn(self.news_events_bank) for _ in range(steps)]
+            with self.news_pool.connection() as news_conn:
+                insert_news_turns(news_conn, first, turns)
+            try:
+                summary = self.writer.submit(advance_market, first, turns, self.news_effects, self.book)
+            except Exception:
+                # Orders popped for matching went back to 'open' with the rollback.
+                with self.users_pool.connection() as conn:
+                    self.book.load(conn)
+                # The clock stays put, so the next inc_time writes these turns' news again.
+                with self.news_pool.connection() as news_conn:
+                    news_conn.execute("DELETE FROM news WHERE time >= ?", (first,))
+                    news_conn.commit()
+                raise
+            TIME = first + steps - 1
+            due = self.cashouts.pop_due(first, TIME)
+            released = self.writer.submit(apply_release_withdrawals, due, TIME) if due else []
+            self.refresh_market()
+            self.metrics.observe_tick(steps, time.perf_counter() - started)
+
+        for wid, username, amount in released:
+            self.broadcaster.publish("withdrawal", {"id": wid, "username": username, "amount": amount,
+                                                    "status": "released"}, username=username)
+
+        published = []
+        for k, items in enumerate(turns[-NEWS_PUSH_TURNS:], start=TIME - min(steps, NEWS_PUSH_TURNS) + 1):
+            for ev in items:
+                published.append({
+                    "time": k,
+                    "time_string": format_time(k),
+                    "headline": ev.get("headline", ""),
+                    "body": ev.get("body", ""),
+                    "effects": ev.get("effects") or {},
+                })
+        if published:
+            self.broadcaster.publish("news", {"time": TIME, "items": published})
+
+        orders = summary.pop("orders")
+        by_user = {}
+        for order in orders:
+            by_user.setdefault(order["username"], []).append(order)
+        for username, mine in by_user.items():
+            last = mine[-1]
+            holdings = {o["symbol"]: o["shares"] for o in mine if o["status"] == "filled"}
+            self.publish_user(username, balance=last["balance"], holdings=holdings)
+            self.broadcaster.publish("orders", {"username": username, "orders": mine}, username=username)
+
+        summary["from_time"] = first - 1
+        summary["news_count"] = sum(len(items) for items in turns)
+        summary["orders_filled"] = sum(1 for o in orders if o["status"] == "filled")
+        summary["orders_rejected"] = len(orders) - summary["orders_filled"]
+        summary["withdrawals_released"] = len(released)
+
+        self.announce_tick({
+            "from_time": first - 1,
+            "time": TIME,
+            "news_count": summary["news_count"],
+            "movers": summary.get("movers") or [],
+            "users": frozenset(by_user) | {username for _, username, _ in released},
+        })
+        return summary
+
+    def announce_tick(self, change: dict) -> None:
+        """Record what the last inc_time changed and wake every parked /wait_tick."""
+        with self.tick_cond:
+            self.last_tick = change
+            self.tick_cond.notify_all()
+            listeners = list(self.tick_listeners)
+        for wake in listeners:
+            wake()
+
+    def tick_change(self, since: int, username: str = "") -> dict | None:
+        """The /wait_tick payload if the clock is past `since`, else None. No DB access."""
+        last = self.last_tick
+        current = last["time"] if last is not None else self.market.time
+        if current <= since:
+            return None
+        payload = {"ok": True, "changed": True, "since": since, "time": current,
+                   "time_string": format_time(current), "stocks_etag": self.market.etag}
+        # Only the last inc_time is remembered: a client further behind than
+        # that just gets told to refresh everything.
+        if last is not None and last["from_time"] <= since:
+            payload["complete"] = True
+            payload["steps"] = current - since
+            payload["news_count"] = last["news_count"]
+            payload["movers"] = last["movers"]
+            if username:
+                payload["you"] = username in last["users"]
+        else:
+            payload["complete"] = False
+        return payload
+
+    def wait_tick(self, wait: TickWait) -> dict:
+        """Block until the clock passes wait.since or the timeout runs out (threaded front-end)."""
+        deadline = time.monotonic() + wait.timeout
+        with self.tick_cond:
+            self.tick_parked += 1
+            try:
+                while True:
+                    change = self.tick_change(wait.since, wait.username)
+                    remaining = deadline - time.monotonic()
+                    if change is not None or remaining <= 0:
+                        break
+                    self.tick_cond.wait(remaining)
+            finally:
+                self.tick_parked -= 1
+        return change or self.tick_unchanged(wait.since)
+
+    def tick_unchanged(self, since: int) -> dict:
+        return {"ok": True, "changed": False, "since": since, "time": self.market.time,
+                "time_string": format_time(self.market.time)}
+
+    def add_tick_listener(self, wake) -> None:
+        """Call wake() (from the ticking thread) on every tick; for the asyncio front-end."""
+        with self.tick_cond:
+            self.tick_listeners.add(wake)
+            self.tick_parked += 1
+
+    def remove_tick_listener(self, wake) -> None:
+        with self.tick_cond:
+            self.tick_listeners.discard(wake)
+            self.tick_parked -= 1
+
+    def dashboard(self, username: str, fields: set, news_limit: int = 3) -> tuple[int, dict]:
+        """Everything the dashboard renders, as of one tick, in one payload.
+
+        Prices come from the cached market snapshot and everything read from
+        the users database happens in one read transaction, so holdings are
+        always valued at the same tick the ticker shows. News is capped at
+        that tick too.
+        """
+        market = self.market
+        payload = {"ok": True, "time": market.time, "time_string": format_time(market.time)}
+
+        with self.users_pool.connection() as conn:
+            conn.execute("BEGIN")
+            try:
+                if fields & {"user", "holdings"}:
+                    urow = conn.execute("SELECT balance FROM users WHERE username = ?", (username,)).fetchone()
+                    if not urow:
+                        return 404, {"ok": False, "error": "user not found"}
+                    balance = int(urow[0])
+                if "users" in fields:
+                    user_rows = conn.execute("SELECT username, balance FROM users ORDER BY username").fetchall()
+                if "holdings" in fields:
+                    holding_rows = conn.execute(
+                        "SELECT symbol, shares FROM holdings WHERE username = ?",
+                        (username,),
+                    ).fetchall()
+            finally:
+                conn.rollback()
+
+        if "user" in fields:
+            payload["user"] = {"username": username, "balance": balance}
+        if "users" in fields:
+            payload["users"] = [{"username": r[0], "balance": r[1]} for r in user_rows]
+        if "stocks" in fields:
+            payload["stocks"] = market.stocks
+        if "holdings" in fields:
+            holdings = []
+            total_value = 0.0
+            for sym, shares in holding_rows:
+                st = market.by_symbol.get(sym)
+                if st is None:
+                    continue
+                value = st["price"] * int(shares)
+                total_value += value
+                holdings.append({
+                    "symbol": sym,
+                    "shares": int(shares),
+                    "name": st["name"],
+                    "industry": st["industry"],
+                    "price": st["price"],
+                    "value": value,
+                })
+            holdings.sort(key=lambda h: (h["industry"], h["symbol"]))
+            payload["holdings"] = {"total_value": total_value, "net_worth": balance + total_value, "items": holdings}
+        if "news" in fields:
+            with self.news_pool.connection() as conn:
+                rows = conn.execute(
+                    "SELECT time, headline, body, effects_json FROM news WHERE time <= ? ORDER BY id DESC LIMIT ?",
+                    (market.time, news_limit),
+                ).fetchall()
+            payload["news"] = [news_row_to_item(row) for row in rows]
+
+        return 200, payload
+
+    def publish_user(self, username: str, balance: int | None = None, holdings: dict | None = None) -> None:
+        """Push a user's new balance and/or share counts to their open streams."""
+        delta = {"username": username}
+        if balance is not None:
+            delta["balance"] = int(balance)
+        if holdings:
+            delta["holdings"] = {sym: int(n) for sym, n in holdings.items()}
+        self.broadcaster.publish("user", delta, username=username)
+
+    def close(self) -> None:
+        self.writer.close()
+        self.users_pool.close()
+        self.news_pool.close()
+
+
+class GameServer(ThreadingHTTPServer):
+    """Thread-per-connection front-end serving one Game."""
+
+    daemon_threads = True
+    # The default listen backlog of 5 resets connections once a table's worth
+    # of phones poll at the same moment.
+    request_queue_size = 64
+
+    def __init__(self, address, handler_cls, game: Game, assets: StaticAssets):
+        super().__init__(address, handler_cls)
+        self.game = game
+        self.assets = assets
+
+    def server_close(self) -> None:
+        super().server_close()
+        self.game.close()
+
+
+class AsyncServer:
+    """asyncio HTTP/1.1 front-end serving one Game.
+
+    One event loop holds every connection, with keep-alive, so idle phones and
+    open /stream subscriptions cost a socket and a small buffer instead of a
+    thread each. Endpoints still run blocking SQLite code, so they go to a
+    thread pool capped at `workers`.
+    """
+
+    def __init__(self, game: Game, assets: StaticAssets, workers: int = ASYNC_WORKERS):
+        self.game = game
+        self.assets = assets
+        self.executor = ThreadPoolExecutor(max_workers=max(1, int(workers)), thread_name_prefix="mm-worker")
+
+    async def serve(self, host: str, port: int) -> None:
+        server = await asyncio.start_server(self.handle_connection, host, port, backlog=1024)
+        async with server:
+            await server.serve_forever()
 
-    host = "0.0.0.0"
-    port = 8888
+    def close(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.game.close()
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        peer = writer.get_extra_info("peername")
+        client_ip = peer[0] if peer else ""
+        try:
+            while True:
+                req, keep_alive = await self.read_request(reader, client_ip)
+                if req is None:
+                    break
+                started = time.perf_counter()
+                resp, acc = await self.respond(req)
+                route = metrics_route(req)
+                if isinstance(resp, StreamResponse):
+                    self.game.metrics.observe_request(route, req.method, 200, time.perf_counter() - started, acc)
+                    await self.serve_stream(writer, resp.username)
+                    break
+                if isinstance(resp, TickWait):
+                    resp = json_response(200, await self.wait_tick(resp))
+                writer.write(encode_response(resp, req, keep_alive))
+                await writer.drain()
+                self.game.metrics.observe_request(route, req.method, resp.status, time.perf_counter() - started, acc)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def read_request(self, reader: asyncio.StreamReader, client_ip: str):
+        """Parse one request off the connection; (None, False) when it is done."""
+        try:
+            line = await asyncio.wait_for(reader.readline(), KEEPALIVE_TIMEOUT)
+        except asyncio.TimeoutError:
+            return None, False
+        while line in (b"\r\n", b"\n"):
+            line = await reader.readline()
+        parts = line.decode("latin-1").split()
+        if len(parts) != 3:
+            return None, False
+        method, target, version = parts
+
+        headers = email.message.Message()
+        for _ in range(MAX_HEADERS):
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip()] = value.strip()
+        else:
+            return None, False
+
+        length = int(headers.get("Content-Length", "0") or 0)
+        body = await reader.readexactly(length) if length > 0 else b""
+
+        connection = (headers.get("Connection") or "").lower()
+        if version == "HTTP/1.1":
+            keep_alive = connection != "close"
+        else:
+            keep_alive = connection == "keep-alive"
+        return Request(method, target, headers, body, client_ip), keep_alive
+
+    async def respond(self, req: Request):
+        """The endpoint's response plus its [db, serialize] time, or None for static files."""
+        loop = asyncio.get_running_loop()
+        endpoint = find_route(req)
+        try:
+            if endpoint is not None:
+                return await loop.run_in_executor(self.executor, run_endpoint, endpoint, self.game, req)
+            if req.method in ("GET", "HEAD"):
+                return self.assets.response(req), None
+            return Response(404, b"", None), None
+        except Exception:
+            traceback.print_exc()
+            return json_response(500, {"ok": False, "error": "internal error"}), None
+
+    async def wait_tick(self, wait: TickWait) -> dict:
+        """Park on the event loop, not a worker thread, until the clock passes wait.since."""
+        loop = asyncio.get_running_loop()
+        woke = asyncio.Event()
+
+        def wake() -> None:
+            try:
+                loop.call_soon_threadsafe(woke.set)
+            except RuntimeError:
+                pass
+
+        deadline = loop.time() + wait.timeout
+        self.game.add_tick_listener(wake)
+        try:
+            while True:
+                woke.clear()
+                change = self.game.tick_change(wait.since, wait.username)
+                remaining = deadline - loop.time()
+                if change is not None or remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(woke.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.game.remove_tick_listener(wake)
+        return change or self.game.tick_unchanged(wait.since)
+
+    async def serve_stream(self, writer: asyncio.StreamWriter, username: str) -> None:
+        loop = asyncio.get_running_loop()
+        inbox = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+
+        def put(frame: bytes) -> None:
+            try:
+                inbox.put_nowait(frame)
+            except asyncio.QueueFull:
+                pass
+
+        def deliver(frame: bytes) -> None:
+            # Called from whichever thread published the event.
+            try:
+                loop.call_soon_threadsafe(put, frame)
+            except RuntimeError:
+                pass
+
+        token = self.game.broadcaster.subscribe(username, deliver)
+        try:
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                b"Cache-Control: no-cache\r\nConnection: close\r\n\r\n"
+                + stream_preamble(self.game)
+            )
+            await writer.drain()
+            while True:
+                try:
+                    frame = await asyncio.wait_for(inbox.get(), STREAM_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    frame = b": keepalive\n\n"
+                writer.write(frame)
+                await writer.drain()
+        finally:
+            self.game.broadcaster.unsubscribe(token)
+
+
+def main() -> None:
+    global TIME, TRUST_FORWARDED
+
+    parser = argparse.ArgumentParser(description="Mega Monopoly 5 server")
+    parser.add_argument("--pool-size", type=int, default=DB_POOL_SIZE,
+                        help="open SQLite connections kept per database (default: %(default)s)")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="serve with the asyncio front-end (keep-alive, no thread per connection)")
+    parser.add_argument("--dev", action="store_true",
+                        help="re-read webapp files when they change instead of serving the startup copy")
+    parser.add_argument("--workers", type=int, default=ASYNC_WORKERS,
+                        help="threads for blocking DB work in --async mode (default: %(default)s)")
+    parser.add_argument("--host", default="0.0.0.0", help="address to listen on (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=8888, help="port to listen on (default: %(default)s)")
+    parser.add_argument("--data-dir", type=Path, default=None,
+                        help="directory holding users.db and news.db (default: next to server.py)")
+    parser.add_argument("--behind-front", action="store_true",
+                        help="running as a rooms.py game worker: take client addresses from X-Forwarded-For")
+    args = parser.parse_args()
+
+    TRUST_FORWARDED = args.behind_front
+    host = args.host
+    port = args.port
 
     projroot = Path(__file__).resolve().parent
     webroot = projroot / "webapp"
     if not webroot.is_dir():
         raise SystemExit(f"webapp directory not found: {webroot}")
 
-    users_db_path = projroot / DB_NAME
-    news_db_path = projroot / NEWS_DB_NAME
+    data_dir = args.data_dir or projroot
+    users_db_path = data_dir / DB_NAME
+    news_db_path = data_dir / NEWS_DB_NAME
 
     init_users_db(users_db_path)
     init_news_db(news_db_path)
@@ -931,21 +3660,34 @@ def main() -> None:
     init_stock_prices_db(users_db_path)
     init_holdings_db(users_db_path)
     seed_stocks_if_empty(users_db_path)
+    upgrade_schema(users_db_path, USERS_MIGRATIONS)
+    upgrade_schema(news_db_path, NEWS_MIGRATIONS)
+    TIME = restore_game_state(users_db_path, news_db_path)
     ensure_history_at_time(users_db_path, TIME)
+    init_stock_candles_db(users_db_path)
 
     events_bank = load_news_events(projroot)
     ensure_initial_news(str(news_db_path), events_bank)
 
-    os.chdir(webroot)
-
-    server = ThreadingHTTPServer((host, port), Handler)
-    server.users_db_path = str(users_db_path)
-    server.news_db_path = str(news_db_path)
-    server.news_events_bank = events_bank
+    game = Game(users_db_path, news_db_path, events_bank, args.pool_size)
+    assets = StaticAssets(webroot, dev=args.dev)
 
-    print(f"Serving {webroot} on http://{host}:{port}")
+    print(f"Serving {webroot} on http://{host}:{port}" + (" (async)" if args.use_async else ""))
     print(f"Users DB at {users_db_path}")
     print(f"News DB at {news_db_path}")
+    print(f"Game clock at {format_time(TIME)} (tick {TIME})")
+
+    if args.use_async:
+        server = AsyncServer(game, assets, args.workers)
+        try:
+            asyncio.run(server.serve(host, port))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+        return
+
+    server = GameServer((host, port), Handler, game, assets)
     server.serve_forever()
 
 
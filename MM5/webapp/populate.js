@@ -4,6 +4,12 @@ const username = params.get("username") || "";
 
 let latestBalance = 0;
 let latestStocksBySymbol = {}; // {SYM: {price, prev_price, ...}}
+let latestHoldings = null; // [{sym, shares}] once /holdings has loaded
+
+// True while the /stream push connection is up; the pollers stand down then.
+let streamLive = false;
+// Last tick we rendered; /wait_tick parks until the server is past it.
+let seenTime = -1;
 
 document.getElementById("u").textContent = username || "?";
 
@@ -134,6 +140,7 @@ async function initNewsTicker() {
     headlines = ["No news yet."];
   }
 
+  tickerHeadlines = headlines;
   const items = headlines.map(h => `<span class="ticker-item">• ${escapeHtml(h)}</span>`).join("");
   inner.innerHTML = items + items;
 
@@ -157,9 +164,6 @@ async function initNewsTicker() {
 
 // Refresh ticker headlines occasionally (cheap + good UX)
 async function refreshTickerHeadlines() {
-  const inner = document.getElementById("newsTickerInner");
-  if (!inner) return;
-
   let headlines = [];
   try {
     const r = await fetch("/news?limit=3");
@@ -167,8 +171,17 @@ async function refreshTickerHeadlines() {
     if (j.ok) headlines = (j.items || []).map(x => x.headline);
   } catch (_) {}
 
+  setTickerHeadlines(headlines);
+}
+
+let tickerHeadlines = [];
+
+function setTickerHeadlines(headlines) {
+  const inner = document.getElementById("newsTickerInner");
+  if (!inner) return;
   if (!headlines.length) return;
 
+  tickerHeadlines = headlines;
   const items = headlines.map(h => `<span class="ticker-item">• ${escapeHtml(h)}</span>`).join("");
   inner.innerHTML = items + items;
 }
@@ -227,11 +240,21 @@ function applyStockToElement(stock) {
   }
 }
 
+// Prices only change on a tick, so send back the last ETag and skip the
+// parse + DOM update when the server answers 304 Not Modified.
+let stocksEtag = null;
+
 async function loadStocks() {
-  const r = await fetch("/stocks");
+  const headers = stocksEtag ? { "If-None-Match": stocksEtag } : {};
+  const r = await fetch("/stocks", { headers, cache: "no-store" });
+  if (r.status === 304) return;
   const j = await r.json();
+  stocksEtag = r.headers.get("ETag");
+  applyMarket(j);
+}
+
+function applyMarket(j) {
   if (!j.ok || !Array.isArray(j.stocks)) return;
-  for (const s of j.stocks) applyStockToElement(s);
   latestStocksBySymbol = {};
   for (const s of j.stocks) {
     latestStocksBySymbol[s.symbol] = s;
@@ -255,34 +278,14 @@ function initStockClicks() {
   }
 }
 
-async function loadPortfolioSummary() {
+function renderPortfolioSummary() {
   const holdingsEl = document.getElementById("holdingsLine");
   const mvEl = document.getElementById("marketValue");
   const nwEl = document.getElementById("netWorth");
   if (!holdingsEl || !mvEl || !nwEl) return;
-  if (!username) return;
+  if (!latestHoldings) return;
 
-  // Fetch holdings
-  let holdings = [];
-  try {
-    const r = await fetch(`/holdings?username=${encodeURIComponent(username)}`);
-    const j = await r.json();
-    if (j.ok) holdings = j.holdings || j.positions || [];
-  } catch (_) {}
-
-  // Ensure we have prices
-  if (!latestStocksBySymbol || Object.keys(latestStocksBySymbol).length === 0) {
-    try { await loadStocks(); } catch (_) {}
-  }
-
-  // Normalise holdings rows
-  const norm = [];
-  for (const h of holdings) {
-    const sym = String(h.symbol || h.ticker || h.stock || "").trim().toUpperCase();
-    const shares = Number(h.shares ?? h.qty ?? h.amount ?? h.amt ?? 0);
-    if (!sym || !Number.isFinite(shares) || shares <= 0) continue;
-    norm.push({ sym, shares });
-  }
+  const norm = latestHoldings.slice();
 
   if (!norm.length) {
     holdingsEl.textContent = "None";
@@ -306,15 +309,133 @@ async function loadPortfolioSummary() {
   nwEl.textContent = `$${((Number(latestBalance) || 0) + mv).toFixed(2)}`;
 }
 
+// --- LEADERBOARD ---
+// Top few by net worth, plus our own rank if we're not among them. Other
+// players' trades aren't pushed to us, so this polls even while streaming.
+async function loadLeaderboard() {
+  const list = document.getElementById("leaderboardList");
+  if (!list) return;
+
+  const r = await fetch(`/leaderboard?limit=5&username=${encodeURIComponent(username)}`);
+  const j = await r.json();
+  if (!j.ok) return;
+
+  const row = e => `<li value="${e.rank}"${e.username === j.you?.username ? ' class="me"' : ""}>`
+    + `<span>${escapeHtml(e.username)}</span> <span class="mono">$${Number(e.net_worth).toFixed(2)}</span></li>`;
+  let html = j.leaders.map(row).join("");
+  if (j.you && !j.leaders.some(e => e.username === j.you.username)) html += row(j.you);
+  list.innerHTML = html;
+}
+
+// --- PUSH UPDATES (/stream) ---
+// The server pushes "tick" (full market snapshot), "news" (new headlines) and
+// "user" (our balance / share counts) events. While the stream is up the
+// pollers below skip their work; if it drops they pick up again until the
+// browser reconnects.
+function startStream() {
+  if (!window.EventSource) return;
+
+  const es = new EventSource(`/stream?username=${encodeURIComponent(username)}`);
+  es.onopen = () => { streamLive = true; };
+  es.onerror = () => { streamLive = false; };
+
+  es.addEventListener("tick", ev => {
+    const j = JSON.parse(ev.data);
+    applyMarket(j);
+    if (j.time_string) document.getElementById("t").textContent = j.time_string;
+    renderPortfolioSummary();
+    loadLeaderboard();
+  });
+
+  es.addEventListener("news", ev => {
+    const j = JSON.parse(ev.data);
+    const fresh = (j.items || []).map(x => x.headline).reverse();
+    setTickerHeadlines(fresh.concat(tickerHeadlines).slice(0, 3));
+  });
+
+  es.addEventListener("user", ev => {
+    const j = JSON.parse(ev.data);
+    if (typeof j.balance === "number") {
+      latestBalance = j.balance;
+      document.getElementById("bal").textContent = j.balance;
+    }
+    if (j.holdings && latestHoldings) {
+      for (const [sym, shares] of Object.entries(j.holdings)) {
+        latestHoldings = latestHoldings.filter(h => h.sym !== sym);
+        if (shares > 0) latestHoldings.push({ sym, shares });
+      }
+    }
+    renderPortfolioSummary();
+  });
+}
+
+// One round-trip for the balance, market and holdings, all as of the same
+// tick. Used for the first paint and as the poller while /stream is down.
+async function loadDashboard() {
+  if (!username) return loadStocks();
+
+  const r = await fetch(`/dashboard?username=${encodeURIComponent(username)}&fields=user,stocks,holdings`);
+  const j = await r.json();
+
+  if (!j.ok) {
+    document.getElementById("bal").textContent = "unknown";
+    document.getElementById("t").textContent = "-";
+    return;
+  }
+
+  document.getElementById("bal").textContent = j.user.balance;
+  latestBalance = Number(j.user.balance) || 0;
+  document.getElementById("t").textContent = j.time_string;
+  seenTime = j.time;
+
+  applyMarket({ ok: true, stocks: j.stocks });
+  latestHoldings = (j.holdings.items || []).map(h => ({ sym: h.symbol, shares: h.shares }));
+  renderPortfolioSummary();
+}
+
+function whenPolling(fn) {
+  return () => { if (!streamLive) fn(); };
+}
+
+// --- LONG-POLL FALLBACK (/wait_tick) ---
+// Phones drop /stream when they sleep. Until it reconnects, keep one request
+// parked on /wait_tick, which answers the moment the clock moves, instead of
+// reloading the dashboard every second. The slow poller below still picks up
+// transfers from other players between ticks.
+const sleep = ms => new Promise(resolve => setTimeout(resolve, ms));
+
+async function waitForTicks() {
+  for (;;) {
+    if (streamLive || !username) {
+      await sleep(2000);
+      continue;
+    }
+    try {
+      const r = await fetch(`/wait_tick?since=${seenTime}&username=${encodeURIComponent(username)}`);
+      const j = await r.json();
+      if (!j.ok) {
+        await sleep(5000);
+      } else if (j.changed && !streamLive) {
+        await loadDashboard();
+        seenTime = Math.max(seenTime, j.time);
+        if (!j.complete || j.news_count) refreshTickerHeadlines();
+        loadLeaderboard();
+      }
+    } catch (e) {
+      await sleep(5000);
+    }
+  }
+}
+
 document.addEventListener("DOMContentLoaded", () => {
   initNewsTicker();
   indexStockElements();
   initStockClicks();
-  loadStocks();
-  setInterval(refreshTickerHeadlines, 6000);
-  setInterval(loadStocks, 1000);
-  loadPortfolioSummary();
-  setInterval(loadPortfolioSummary, 1000);
+  loadDashboard();
+  loadLeaderboard();
+  setInterval(loadLeaderboard, 5000);
+  setInterval(whenPolling(refreshTickerHeadlines), 6000);
+  setInterval(whenPolling(loadDashboard), 10000);
+  startStream();
+  waitForTicks();
 });
-loadUser();
-setInterval(loadUser, 1000);